@@ -1 +1,4 @@
-import creAI.__main__
\ No newline at end of file
+import creAI.__main__
+
+if __name__ == '__main__':
+    creAI.__main__.main()
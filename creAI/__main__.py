@@ -1,4 +1,15 @@
+import multiprocessing
+
 from creAI import App
 
-app = App()
-app.run()
+
+def main():
+    # The workers of the batch commands re-run the entry point of frozen
+    # builds, this makes them run the worker instead
+    multiprocessing.freeze_support()
+    app = App()
+    app.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,18 @@
 import argparse
 import configparser
+import csv
 import json
 import io
 import sys
 import platform
-from os import PathLike
-from os.path import join, dirname, abspath
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import PathLike, walk, makedirs
+from os.path import join, dirname, abspath, isdir, isfile, relpath
 import eel
 import traceback
 
+from creAI.exceptions import *
 from creAI.style import Style
 from creAI.cli import CommandlineInterface, command, default_command
 from creAI.mc import Schematic
@@ -53,6 +57,109 @@ def handle_exceptions(func):
     return wrapper
 
 
+def find_schematics(pth):
+    """Lists a schematic file or the schematics in a directory tree.
+
+    Args:
+        pth (str): Path of a file or a directory.
+
+    Returns:
+        tuple: The root directory and the sorted list of schematic paths.
+    """
+    if isfile(pth):
+        return dirname(pth), [pth]
+    if not isdir(pth):
+        raise SchematicFileMissing(pth)
+    schem_pths = []
+    for dir_pth, _, file_names in walk(pth):
+        schem_pths += [join(dir_pth, f) for f in file_names
+                       if f.endswith('.schem')]
+    return pth, sorted(schem_pths)
+
+
+def process_schematic(schem_pth, output_pth=None, mc_version=None):
+    """Loads a schematic and optionally saves it again.
+
+    This runs in the worker processes of the batch commands, so it reports
+    errors instead of raising them.
+
+    Args:
+        schem_pth (str): Path of the schematic.
+        output_pth (str): Where to save the schematic, if given.
+        mc_version (str): Minecraft version of the tiles.
+
+    Returns:
+        tuple: Path, elapsed seconds and the error message or None.
+    """
+    start = time.perf_counter()
+    try:
+        with open(schem_pth, 'rb') as schem_file:
+            schem = Schematic.load(schem_file, version=mc_version)
+        if output_pth is not None:
+            makedirs(dirname(output_pth) or '.', exist_ok=True)
+            with open(output_pth, 'wb') as schem_file:
+                schem.save(schem_file)
+        error = None
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return schem_pth, time.perf_counter() - start, error
+
+
+def process_schematics(pth, output=None, mc_version=None, workers=None,
+                       report=None):
+    """Processes a directory of schematics on a pool of processes.
+
+    Args:
+        pth (str): Path of a schematic or a directory of schematics.
+        output (str): Directory to save the schematics to, keeping their
+            relative paths, or None to only load them.
+        mc_version (str): Minecraft version of the tiles.
+        workers (int): Number of worker processes, the number of cores by
+            default.
+        report (str): Path of a CSV file to write the results to.
+
+    Returns:
+        list: Path, elapsed seconds and error message of every schematic.
+    """
+    root, schem_pths = find_schematics(pth)
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                process_schematic,
+                schem_pth,
+                None if output is None
+                else join(output, relpath(schem_pth, root)),
+                mc_version
+            )
+            for schem_pth in schem_pths
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            if result[2] is not None:
+                print('{}\t{}'.format(result[0], result[2]))
+            results.append(result)
+    results.sort()
+
+    if report is not None:
+        with open(report, 'w', newline='') as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(['file', 'status', 'seconds', 'error'])
+            for schem_pth, elapsed, error in results:
+                writer.writerow([
+                    schem_pth,
+                    'ok' if error is None else 'failed',
+                    '{:.3f}'.format(elapsed),
+                    error or ''
+                ])
+
+    failed = sum(1 for r in results if r[2] is not None)
+    print('{} schematics processed in {:.1f} s, {} failed.'.format(
+        len(results), time.perf_counter() - start, failed))
+    return results
+
+
 class App(CommandlineInterface):
     """Generates Minecraft tilemaps via a selection of deep learning models.
 
@@ -171,6 +278,45 @@ class App(CommandlineInterface):
                 self.tlmp.save(schem_file)
         print(self.tlmp)
 
+    @command
+    @handle_exceptions
+    def validate(self, schem, workers, report):
+        """Validate subcommand.
+
+        Load a schematic or every schematic of a directory (recursively)
+        on multiple processes, and print the ones that fail to load.
+
+        Args:
+            schem (str): A schematic file or a directory of schematics.
+            workers (int, optional): Number of worker processes, the number
+                of cores by default.
+            report (str, optional): Save the status, loading time and error
+                of every file into this CSV file.
+        """
+        process_schematics(schem, workers=workers, report=report)
+
+    @command
+    @handle_exceptions
+    def convert(self, schem, output, mc_version, workers, report):
+        """Convert subcommand.
+
+        Load a schematic or every schematic of a directory (recursively)
+        on multiple processes, and save them in the format written by
+        creAI (Sponge schematic version 2 with a compact palette) into the
+        output directory, keeping their relative paths.
+
+        Args:
+            schem (str): A schematic file or a directory of schematics.
+            output (str): The directory of the converted schematics.
+            mc_version (str, optional): The Minecraft version of the tiles.
+            workers (int, optional): Number of worker processes, the number
+                of cores by default.
+            report (str, optional): Save the status, processing time and
+                error of every file into this CSV file.
+        """
+        process_schematics(schem, output=output, mc_version=mc_version,
+                           workers=workers, report=report)
+
     @default_command
     @handle_exceptions
     def start_gui(self):
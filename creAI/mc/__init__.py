@@ -1,5 +1,5 @@
 """Minecraft tilemap manipulation package."""
 
 from creAI.mc.tile import Tile
-from creAI.mc.tilemap import Tilemap
+from creAI.mc.tilemap import Tilemap, TilemapView
 from creAI.mc.schematic import Schematic
@@ -0,0 +1,648 @@
+"""Anvil region file module.
+
+Minecraft worlds are stored in region files (r.<x>.<z>.mca) of 32x32
+chunks. A region file starts with a table of the locations of the chunks in
+4096 byte sectors and a table of their timestamps, followed by the chunks,
+each of them is a zlib compressed NBT tree. The blocks of a chunk are stored
+in sections of 16x16x16 blocks, every section has its own palette of block
+states and packs its palette indices into a long array.
+
+This module writes tilemaps straight into region files, so generated
+structures can be placed into a world without pasting a schematic, and
+reads boxes of region files into tilemaps.
+"""
+
+import io
+import os
+import struct
+import tempfile
+import time
+import zlib
+import gzip
+import numpy as np
+
+from creAI.mc import nbt
+from creAI.mc.tile import Tile
+from creAI.mc.tilemap import Tilemap, index_dtype
+
+
+# Size of the location and timestamp tables and the unit of allocation
+sector_size = 4096
+# Length of a chunk in bytes and its compression type
+chunk_header_format = struct.Struct(">IB")
+GZIP_COMPRESSION = 1
+ZLIB_COMPRESSION = 2
+# Minecraft 1.15.2
+default_data_version = 2230
+# Block states don't span over two longs from this version (1.16)
+padded_block_states_version = 2527
+# Sections are stored in a different structure from this version (1.18)
+unsupported_data_version = 2825
+
+section_shape = (16, 16, 16)
+region_chunks = 32
+
+
+def block_state_bits(palette_size: int) -> int:
+    """Returns the number of bits a section uses for a palette index."""
+    return max(4, int(palette_size - 1).bit_length())
+
+
+def pack_block_states(indices: np.ndarray, bits: int,
+                      padded: bool = False) -> np.ndarray:
+    """Packs palette indices into 64 bit integers.
+
+    Every index takes bits bits, starting from the least significant bit of
+    the first long. Before Minecraft 1.16 an index may continue in the next
+    long, from 1.16 the unused high bits of every long are left zero
+    instead (padded). The packing is vectorized: the bits of the indices are
+    laid out in one array, then every 64 of them are packed into a long.
+
+    Args:
+        indices (np.ndarray): Non-negative integers, flattened in C order.
+        bits (int): Number of bits per index.
+        padded (bool): Don't split indices between longs.
+
+    Returns:
+        np.ndarray: Array of signed 64 bit integers.
+    """
+    indices = np.ravel(indices)
+    index_bits = (indices[:, None] >> np.arange(bits)) & 1
+    if padded:
+        per_long = 64 // bits
+        longs = -(-indices.size // per_long)
+        lanes = np.zeros((longs * per_long, bits), dtype=index_bits.dtype)
+        lanes[:indices.size] = index_bits
+        index_bits = np.zeros((longs, 64), dtype=index_bits.dtype)
+        index_bits[:, :per_long * bits] = lanes.reshape((longs, -1))
+    else:
+        longs = -(-indices.size * bits // 64)
+        index_bits = np.concatenate((
+            index_bits.ravel(),
+            np.zeros(longs * 64 - indices.size * bits, index_bits.dtype)
+        ))
+    packed = np.packbits(index_bits.astype(np.uint8).reshape((-1, 64)),
+                         axis=1, bitorder='little')
+    return packed.view('<i8').ravel()
+
+
+def unpack_block_states(block_states: np.ndarray, bits: int,
+                        count: int = 4096, padded: bool = False) -> np.ndarray:
+    """Unpacks palette indices from 64 bit integers.
+
+    The inverse of pack_block_states. The longs are split into their bits
+    at once, then every bits bits are summed into an index.
+
+    Args:
+        block_states (np.ndarray): Array of 64 bit integers.
+        bits (int): Number of bits per index.
+        count (int): Number of indices to unpack.
+        padded (bool): Indices are not split between longs.
+
+    Returns:
+        np.ndarray: The indices.
+    """
+    longs = np.ascontiguousarray(block_states, dtype='<i8')
+    long_bits = np.unpackbits(longs.view(np.uint8), bitorder='little')
+    if padded:
+        per_long = 64 // bits
+        long_bits = long_bits.reshape((-1, 64))[:, :per_long * bits]
+    long_bits = long_bits.reshape(-1)
+    if long_bits.size < count * bits:
+        raise ValueError(
+            "BlockStates contains only {} indices instead of {}!".format(
+                long_bits.size // bits, count))
+    index_bits = long_bits[:count * bits].reshape((count, bits))
+    return index_bits.astype(int) @ (1 << np.arange(bits))
+
+
+def tile_to_block_state(tile: Tile) -> nbt.TAG_Compound:
+    """Builds the palette entry of a section from a tile."""
+    block_state = nbt.TAG_Compound()
+    block_state['Name'] = nbt.TAG_String(payload=tile.id.split('[')[0])
+    properties = [d_v for d_v in tile.data_values if d_v]
+    if properties:
+        properties_tag = nbt.TAG_Compound()
+        for d_v in properties:
+            key, value = d_v.split('=')
+            properties_tag[key] = nbt.TAG_String(payload=value)
+        block_state['Properties'] = properties_tag
+    return block_state
+
+
+def block_state_to_tile(block_state: nbt.TAG_Compound,
+                        version: str = None) -> Tile:
+    """Creates a tile from the palette entry of a section."""
+    id_ = block_state['Name'].payload
+    properties = block_state.get('Properties')
+    if properties is not None and properties.payload:
+        id_ += '[{}]'.format(','.join(
+            '{}={}'.format(key, tag.payload)
+            for key, tag in properties.items()))
+    return Tile(id_, version=version)
+
+
+def region_path(directory, region_x: int, region_z: int) -> str:
+    """Returns the path of a region file in a world's region directory."""
+    return os.path.join(directory, 'r.{}.{}.mca'.format(region_x, region_z))
+
+
+class RegionWriter(object):
+    """Writes chunks into a new region file.
+
+    The chunks are compressed and appended to the file one by one, every
+    chunk starts at a sector boundary. The location and timestamp tables
+    are written when the writer is closed.
+
+    Args:
+        file: Writable and seekable binary file object.
+        compresslevel (int): Zlib compression level.
+    """
+    def __init__(self, file, compresslevel=6):
+        self.file = file
+        self.compresslevel = compresslevel
+        self.locations = np.zeros(region_chunks**2, dtype='>u4')
+        self.timestamps = np.zeros(region_chunks**2, dtype='>u4')
+        self.next_sector = 2
+        self.file.write(bytes(2 * sector_size))
+
+    def write_chunk(self, x: int, z: int, root_tag: nbt.TAG_Compound):
+        """Appends a chunk.
+
+        Args:
+            x (int): Chunk X coordinate, only its lowest 5 bits are used.
+            z (int): Chunk Z coordinate, only its lowest 5 bits are used.
+            root_tag (TAG_Compound): NBT tree of the chunk.
+        """
+        buffer_ = io.BytesIO()
+        nbt.save(root_tag, buffer_, compresslevel=None)
+        data = zlib.compress(buffer_.getvalue(), self.compresslevel)
+        self.write_raw(x, z, ZLIB_COMPRESSION, data)
+
+    def write_raw(self, x: int, z: int, compression: int, data: bytes,
+                  timestamp: int = None):
+        """Appends a compressed chunk, like the ones of RegionReader.read_raw.
+
+        Args:
+            x (int): Chunk X coordinate, only its lowest 5 bits are used.
+            z (int): Chunk Z coordinate, only its lowest 5 bits are used.
+            compression (int): Compression type of the data.
+            data (bytes): The compressed NBT tree of the chunk.
+            timestamp (int): Last modification time, the current time by
+                default.
+        """
+        length = chunk_header_format.size + len(data)
+        sectors = -(-length // sector_size)
+        if sectors > 255:
+            raise ValueError(
+                "Chunk ({}, {}) is too big for a region file!".format(x, z))
+        self.file.write(chunk_header_format.pack(len(data) + 1, compression))
+        self.file.write(data)
+        self.file.write(bytes(sectors * sector_size - length))
+        index = (x % region_chunks) + (z % region_chunks) * region_chunks
+        self.locations[index] = self.next_sector << 8 | sectors
+        self.timestamps[index] = int(time.time()) if timestamp is None \
+            else timestamp
+        self.next_sector += sectors
+
+    def close(self):
+        """Writes the location and timestamp tables."""
+        self.file.seek(0)
+        self.file.write(self.locations.tobytes())
+        self.file.write(self.timestamps.tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class RegionReader(object):
+    """Reads chunks of a region file.
+
+    Only the location and timestamp tables are read when the reader is
+    created, every chunk is read and decompressed on its own when it is
+    requested.
+
+    Args:
+        file: Readable and seekable binary file object.
+    """
+    def __init__(self, file):
+        self.file = file
+        header = file.read(2 * sector_size)
+        if len(header) < 2 * sector_size:
+            raise ValueError("Region file is shorter than its header!")
+        self.locations = np.frombuffer(header[:sector_size], dtype='>u4')
+        self.timestamps = np.frombuffer(header[sector_size:], dtype='>u4')
+
+    def read_raw(self, x: int, z: int):
+        """Reads a chunk without decompressing it.
+
+        Args:
+            x (int): Chunk X coordinate, only its lowest 5 bits are used.
+            z (int): Chunk Z coordinate, only its lowest 5 bits are used.
+
+        Returns:
+            tuple: Compression type, compressed data and timestamp of the
+            chunk, None if the chunk is not generated.
+        """
+        index = (x % region_chunks) + (z % region_chunks) * region_chunks
+        location = int(self.locations[index])
+        if location == 0:
+            return None
+        self.file.seek((location >> 8) * sector_size)
+        length, compression = chunk_header_format.unpack(
+            self.file.read(chunk_header_format.size))
+        return compression, self.file.read(length - 1), \
+            int(self.timestamps[index])
+
+    def read_chunk(self, x: int, z: int, lazy: bool = False):
+        """Loads a chunk.
+
+        Args:
+            x (int): Chunk X coordinate, only its lowest 5 bits are used.
+            z (int): Chunk Z coordinate, only its lowest 5 bits are used.
+            lazy (bool): Load the NBT tree lazily, see nbt.load.
+
+        Returns:
+            TAG_Compound: NBT tree of the chunk, None if the chunk is not
+            generated.
+        """
+        raw = self.read_raw(x, z)
+        if raw is None:
+            return None
+        compression, data, _ = raw
+        if compression == ZLIB_COMPRESSION:
+            data = zlib.decompress(data)
+        elif compression == GZIP_COMPRESSION:
+            data = gzip.decompress(data)
+        else:
+            raise ValueError(
+                "Chunk ({}, {}) has unknown compression type {}!".format(
+                    x, z, compression))
+        return nbt.load(io.BytesIO(data), lazy=lazy)
+
+
+def build_chunk(x: int, z: int, sections: list,
+                data_version: int = default_data_version) -> nbt.TAG_Compound:
+    """Builds the NBT tree of a chunk.
+
+    Light, heightmaps and biomes are left out, the game computes them when
+    the chunk is loaded.
+
+    Args:
+        x (int): Chunk X coordinate.
+        z (int): Chunk Z coordinate.
+        sections (list of TAG_Compound): Sections of the chunk.
+        data_version (int): Minecraft data version of the chunk.
+
+    Returns:
+        TAG_Compound: The root tag.
+    """
+    sections_tag = nbt.TAG_List(name='Sections')
+    sections_tag.element_type = nbt.TAG_COMPOUND
+    sections_tag.payload = sections
+    level = nbt.TAG_Compound(name='Level')
+    level.payload = [
+        nbt.TAG_Int(name='xPos', payload=x),
+        nbt.TAG_Int(name='zPos', payload=z),
+        nbt.TAG_Long(name='LastUpdate', payload=0),
+        nbt.TAG_Long(name='InhabitedTime', payload=0),
+        nbt.TAG_String(name='Status', payload='full'),
+        nbt.TAG_Byte(name='isLightOn', payload=0),
+        sections_tag,
+    ]
+    for name in ('Entities', 'TileEntities'):
+        empty = nbt.TAG_List(name=name)
+        empty.element_type = nbt.TAG_COMPOUND
+        level.append(empty)
+    root_tag = nbt.TAG_Compound()
+    root_tag.payload = [
+        nbt.TAG_Int(name='DataVersion', payload=data_version),
+        level,
+    ]
+    return root_tag
+
+
+def build_section(y: int, indices: np.ndarray, block_states: list,
+                  padded: bool = False) -> nbt.TAG_Compound:
+    """Builds a section from the palette indices of its blocks.
+
+    Args:
+        y (int): Section Y coordinate.
+        indices (np.ndarray): 16x16x16 array of indices into block_states in
+            y, z, x order.
+        block_states (list of TAG_Compound): Palette entries of every index.
+        padded (bool): Pack the block states in the format of Minecraft
+            1.16 and later.
+
+    Returns:
+        TAG_Compound: The section.
+    """
+    used, local_indices = np.unique(indices, return_inverse=True)
+    palette_tag = nbt.TAG_List(name='Palette')
+    palette_tag.element_type = nbt.TAG_COMPOUND
+    palette_tag.payload = [block_states[idx] for idx in used]
+    section = nbt.TAG_Compound()
+    section.payload = [
+        nbt.TAG_Byte(name='Y', payload=y),
+        palette_tag,
+        nbt.TAG_Long_Array(
+            name='BlockStates',
+            payload=pack_block_states(
+                local_indices, block_state_bits(used.size), padded)
+        ),
+    ]
+    return section
+
+
+def export_tilemap(tlmp: Tilemap, directory, origin: tuple = (0, 0, 0),
+                   data_version: int = default_data_version,
+                   compresslevel: int = 6, overwrite: bool = False) -> list:
+    """Writes a tilemap into region files.
+
+    The tilemap is merged into the existing region files: the chunks it
+    doesn't intersect are copied as they are, and in the chunks it
+    intersects only the blocks of the tilemap are replaced. These chunks
+    keep their DataVersion, their light and heightmaps are dropped, so the
+    game recomputes them. Missing chunks are created, their blocks outside
+    of the tilemap are air. The region files are written one at a time
+    into temporary files, which replace the old ones when they are
+    complete, and only a single chunk is held in memory besides the
+    tilemap.
+
+    Args:
+        tlmp (Tilemap): The tilemap.
+        directory (str): The region directory of a world.
+        origin (tuple of int): World coordinates of the tilemap's first
+            block.
+        data_version (int): Minecraft data version of the new chunks, up
+            to Minecraft 1.17.
+        compresslevel (int): Zlib compression level.
+        overwrite (bool): Replace the existing region files instead of
+            merging into them, needed when they contain chunks that can't
+            be merged.
+
+    Returns:
+        list of str: Paths of the written region files.
+    """
+    if data_version >= unsupported_data_version:
+        raise ValueError(
+            "Chunks of DataVersion {} are not supported!".format(data_version))
+    w, h, l = tlmp.shape
+    x0, y0, z0 = origin
+    if y0 < 0 or y0 + h > 256:
+        raise ValueError(
+            "The tilemap doesn't fit into the world's height: "
+            "y from {} to {}".format(y0, y0 + h))
+
+    block_states = [tile_to_block_state(t) for t in tlmp.palette]
+    # Indices of the block states by tile id, block states of the merged
+    # chunks are added to them
+    ids = {}
+    for idx, t in enumerate(tlmp.palette):
+        ids.setdefault(t.id, idx)
+    air = ids.setdefault('minecraft:air', len(block_states))
+    if air == len(block_states):
+        block_states.append(tile_to_block_state(Tile('minecraft:air')))
+
+    chunks_x = range(x0 // 16, (x0 + w - 1) // 16 + 1)
+    chunks_z = range(z0 // 16, (z0 + l - 1) // 16 + 1)
+    regions = sorted({(cx // region_chunks, cz // region_chunks)
+                      for cx in chunks_x for cz in chunks_z})
+
+    os.makedirs(directory, exist_ok=True)
+    pths = []
+    for rx, rz in regions:
+        pth = region_path(directory, rx, rz)
+        old_file = None
+        fd, tmp_pth = tempfile.mkstemp(suffix='.mca', dir=directory)
+        try:
+            if os.path.isfile(pth) and not overwrite:
+                old_file = open(pth, 'rb')
+            reader = RegionReader(old_file) if old_file else None
+            with os.fdopen(fd, 'wb') as region_file, \
+                    RegionWriter(region_file, compresslevel) as writer:
+                for cz in range(rz * region_chunks,
+                                (rz + 1) * region_chunks):
+                    for cx in range(rx * region_chunks,
+                                    (rx + 1) * region_chunks):
+                        if cx not in chunks_x or cz not in chunks_z:
+                            # Chunks outside of the tilemap are copied
+                            raw = reader.read_raw(cx, cz) if reader else None
+                            if raw is not None:
+                                writer.write_raw(cx, cz, *raw)
+                            continue
+                        chunk = reader.read_chunk(cx, cz) if reader else None
+                        if chunk is None:
+                            chunk = build_chunk(cx, cz, [], data_version)
+                        _merge_chunk(chunk, (cx, cz), origin, tlmp.data,
+                                     block_states, ids, air)
+                        writer.write_chunk(cx, cz, chunk)
+            if old_file:
+                old_file.close()
+            os.replace(tmp_pth, pth)
+        finally:
+            if old_file:
+                old_file.close()
+            if os.path.exists(tmp_pth):
+                os.remove(tmp_pth)
+        pths.append(pth)
+    return pths
+
+
+def _merge_chunk(chunk, position, origin, data, block_states, ids, air):
+    """Replaces the blocks of a chunk inside a tilemap's box.
+
+    Args:
+        chunk (TAG_Compound): NBT tree of the chunk, modified in place.
+        position (tuple of int): Chunk X and Z coordinates.
+        origin (tuple of int): World coordinates of the tilemap's first
+            block.
+        data (np.ndarray): Indices of the tilemap's blocks.
+        block_states (list of TAG_Compound): Palette entries of every index,
+            the block states of the chunk are appended to it.
+        ids (dict): Tile ids of block_states and their indices.
+        air (int): Index of air in block_states.
+    """
+    cx, cz = position
+    data_version = chunk['DataVersion'].payload \
+        if 'DataVersion' in chunk else 0
+    if data_version >= unsupported_data_version or 'Level' not in chunk:
+        raise ValueError(
+            "Chunk ({}, {}) of DataVersion {} can't be merged, export with "
+            "overwrite=True to replace the region file!".format(
+                cx, cz, data_version))
+    padded = data_version >= padded_block_states_version
+    level = chunk['Level']
+    if 'Sections' not in level:
+        level['Sections'] = nbt.TAG_List()
+        level['Sections'].element_type = nbt.TAG_COMPOUND
+    sections_tag = level['Sections']
+    sections = {s['Y'].payload: s for s in sections_tag.payload}
+
+    y0 = origin[1]
+    for sy in range(y0 // 16, (y0 + data.shape[1] - 1) // 16 + 1):
+        section = sections.get(sy)
+        # Sections are stored in y, z, x order
+        indices = np.full(section_shape, air, dtype=int)
+        if section is not None and 'Palette' in section \
+                and 'BlockStates' in section:
+            palette = section['Palette'].payload
+            lut = np.empty(len(palette), dtype=int)
+            for idx, block_state in enumerate(palette):
+                id_ = block_state_to_tile(block_state).id
+                lut[idx] = ids.setdefault(id_, len(block_states))
+                if lut[idx] == len(block_states):
+                    block_states.append(block_state)
+            indices = lut[unpack_block_states(
+                section['BlockStates'].payload,
+                block_state_bits(len(palette)),
+                padded=padded
+            ).reshape(section_shape)]
+
+        # Bounds of the section in tilemap coordinates
+        lo = np.array((cx, sy, cz)) * 16 - origin
+        src_lo = np.maximum(lo, 0)
+        src_hi = np.minimum(lo + 16, data.shape)
+        dst_lo = src_lo - lo
+        dst_hi = src_hi - lo
+        indices[dst_lo[1]:dst_hi[1],
+                dst_lo[2]:dst_hi[2],
+                dst_lo[0]:dst_hi[0]] = np.asarray(data[
+                    src_lo[0]:src_hi[0],
+                    src_lo[1]:src_hi[1],
+                    src_lo[2]:src_hi[2]]).transpose((1, 2, 0))
+        if section is None and (indices == air).all():
+            continue
+
+        built = build_section(sy, indices, block_states, padded)
+        if section is None:
+            sections_tag.payload.append(built)
+        else:
+            section['Palette'] = built['Palette']
+            section['BlockStates'] = built['BlockStates']
+            # The light of the section is recomputed by the game
+            section.payload = [t for t in section.payload
+                               if t.name not in ('BlockLight', 'SkyLight')]
+
+    level['isLightOn'] = nbt.TAG_Byte(payload=0)
+    level.payload = [t for t in level.payload if t.name != 'Heightmaps']
+
+
+def import_tilemap(directory, origin: tuple, size: tuple,
+                   version: str = None) -> Tilemap:
+    """Loads a box of a world into a tilemap.
+
+    The chunks intersecting the box are read one by one, only their
+    sections intersecting the box are unpacked, so the memory usage depends
+    on the size of the box and not on the size of the region files. Blocks
+    of missing region files, chunks and sections are air.
+
+    Args:
+        directory (str): The region directory of a world.
+        origin (tuple of int): World coordinates of the box's first block.
+        size (tuple of int): Width, height and length of the box.
+        version (str): Minecraft version of the tiles.
+
+    Returns:
+        Tilemap: The blocks of the box.
+    """
+    x0, y0, z0 = origin
+    w, h, l = size
+    if min(size) <= 0:
+        raise ValueError("Invalid box size {}!".format(tuple(size)))
+
+    ids = {'minecraft:air': 0}
+    data = np.zeros((w, h, l), dtype=index_dtype(1))
+    readers = {}
+    files = []
+    try:
+        for cz in range(z0 // 16, (z0 + l - 1) // 16 + 1):
+            for cx in range(x0 // 16, (x0 + w - 1) // 16 + 1):
+                region = (cx // region_chunks, cz // region_chunks)
+                if region not in readers:
+                    pth = region_path(directory, *region)
+                    readers[region] = None
+                    if os.path.isfile(pth):
+                        files.append(open(pth, 'rb'))
+                        readers[region] = RegionReader(files[-1])
+                if readers[region] is None:
+                    continue
+                chunk = readers[region].read_chunk(cx, cz, lazy=True)
+                if chunk is None:
+                    continue
+                data = _copy_chunk(chunk, (cx, cz), origin, data, ids)
+    finally:
+        for region_file in files:
+            region_file.close()
+
+    palette = [None] * len(ids)
+    for id_, idx in ids.items():
+        palette[idx] = Tile(id_)
+    return Tilemap(data=data, palette=palette, version=version)
+
+
+def _copy_chunk(chunk, position, origin, data, ids):
+    """Copies the sections of a chunk into the blocks of a box.
+
+    The data type of the blocks is promoted if the new block states don't
+    fit into it.
+
+    Args:
+        chunk (TAG_Compound): NBT tree of the chunk.
+        position (tuple of int): Chunk X and Z coordinates.
+        origin (tuple of int): World coordinates of the box's first block.
+        data (np.ndarray): Indices of the blocks of the box, in x, y, z
+            order.
+        ids (dict): Tile ids of the box's palette and their indices, new
+            block states are added to it.
+
+    Returns:
+        np.ndarray: The blocks of the box.
+    """
+    data_version = chunk['DataVersion'].payload \
+        if 'DataVersion' in chunk else 0
+    if data_version >= unsupported_data_version or 'Level' not in chunk:
+        raise ValueError(
+            "Chunks of DataVersion {} are not supported!".format(data_version))
+    padded = data_version >= padded_block_states_version
+    sections = chunk['Level'].get('Sections')
+    if sections is None:
+        return data
+
+    cx, cz = position
+    for section in sections.payload:
+        if 'BlockStates' not in section or 'Palette' not in section:
+            continue
+        # Bounds of the section in box coordinates
+        lo = np.array((cx, section['Y'].payload, cz)) * 16 - origin
+        src_lo = np.maximum(-lo, 0)
+        src_hi = np.minimum(data.shape - lo, 16)
+        if (src_hi <= src_lo).any():
+            continue
+        dst_lo = lo + src_lo
+        dst_hi = lo + src_hi
+
+        palette = section['Palette'].payload
+        lut = np.empty(len(palette), dtype=int)
+        for idx, block_state in enumerate(palette):
+            id_ = block_state_to_tile(block_state).id
+            lut[idx] = ids.setdefault(id_, len(ids))
+        if len(ids) - 1 > np.iinfo(data.dtype).max:
+            data = data.astype(index_dtype(len(ids)))
+        indices = unpack_block_states(
+            section['BlockStates'].payload,
+            block_state_bits(len(palette)),
+            padded=padded
+        ).reshape(section_shape)
+        # Sections are stored in y, z, x order
+        data[dst_lo[0]:dst_hi[0],
+             dst_lo[1]:dst_hi[1],
+             dst_lo[2]:dst_hi[2]] = lut[indices[
+                 src_lo[1]:src_hi[1],
+                 src_lo[2]:src_hi[2],
+                 src_lo[0]:src_hi[0]].transpose((2, 0, 1))]
+    return data
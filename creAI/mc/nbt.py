@@ -6,44 +6,69 @@
 
 from __future__ import print_function
 
+import collections
+import concurrent.futures
+import contextlib
+import fnmatch
 import gzip
 import io
 import struct
 import sys
 import time
+import zlib
 
 import numpy as np
 
 
+# Precompiled formats of the length prefixes
+string_length_format = struct.Struct(">H")
+array_length_format = struct.Struct(">i")
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
 class TAG(object):
     """ Base class for named binary tags.
 
+    Tags use __slots__ to keep large trees small. Tags created by the
+    constructor or the payload setter have their payload validated, tags
+    created by the loader are trusted and skip these checks.
+
     Args:
         name (str): name of the tag
         payload: data associated with the tag
     """
+    # _lazy is the source of a payload that has not been decoded yet,
+    # see load(lazy=True)
+    __slots__ = ('_name', '_payload', '_lazy')
+    # Number of times a named tag was renamed, compounds rebuild their name
+    # index when it changes
+    _renames = 0
 
     def __init__(self, name="", payload=0):
         self.name = name
         self.payload = payload
 
-    _name = None
-    _payload = None
-
     @property
     def name(self):
         return self._name
 
     @name.setter
     def name(self, new_name):
-        self._name = str(new_name)
+        new_name = str(new_name)
+        if getattr(self, '_name', '') not in ('', new_name):
+            TAG._renames += 1
+        self._name = new_name
 
     @property
     def payload(self):
+        if self._lazy is not None:
+            self._load_lazy()
         return self._payload
 
     @payload.setter
     def payload(self, new_payload):
+        self._lazy = None
         self._payload = self.payload_type(new_payload)
 
     def __str__(self):
@@ -56,7 +81,8 @@ class TAG(object):
         Sets the offset to the end of the payload.
 
         Args:
-            raw_data (np.ndarray): byte array
+            raw_data (memoryview): byte buffer, it is never sliced, so the
+                whole file is parsed without copying the remaining data
             data_offset (List[int]): offset in the raw data expressed in number of
                 bytes, it is a list because it has to be a mutable object in
                 order to pass it by reference
@@ -64,22 +90,93 @@ class TAG(object):
         Returns:
             TAG: tag with the payload
         """
-        data = raw_data[data_offset[0]:]
-        payload = None
-        (payload,) = cls.payload_format.unpack_from(data)
-        self = cls(payload=payload)
-        data_offset[0] += self.payload_format.size
+        (payload,) = cls.payload_format.unpack_from(raw_data, data_offset[0])
+        self = cls._trusted(payload)
+        data_offset[0] += cls.payload_format.size
+
+        return self
+
+    @classmethod
+    def _trusted(cls, payload, name=""):
+        """ Creates a tag without validating the payload.
+
+        Used by the loader, where the payload is already of the right type.
+
+        Args:
+            payload: data associated with the tag
+            name (str): name of the tag
+
+        Returns:
+            TAG: the new tag
+        """
+        self = cls.__new__(cls)
+        self._name = name
+        self._payload = payload
+        self._lazy = None
+        return self
+
+    @classmethod
+    def skip_payload(cls, raw_data, data_offset):
+        """ Sets the offset to the end of the payload without decoding it.
+
+        Args:
+            raw_data (memoryview): byte buffer
+            data_offset (List[int]): offset in the raw data
+        """
+        data_offset[0] += cls.payload_format.size
+
+    @classmethod
+    def index_payload(cls, raw_data, data_offset):
+        """ Indexes the payload for lazy loading.
+
+        Sets the offset to the end of the payload.
+
+        Args:
+            raw_data (memoryview): byte buffer
+            data_offset (List[int]): offset in the raw data
+
+        Returns:
+            The information needed by from_index to build the tag later, by
+            default the offset of the payload.
+        """
+        offset = data_offset[0]
+        cls.skip_payload(raw_data, data_offset)
+        return offset
+
+    @classmethod
+    def from_index(cls, raw_data, index):
+        """ Builds a tag from the result of index_payload.
+
+        Scalar payloads are cheap, so they are decoded right away.
+
+        Args:
+            raw_data (memoryview): byte buffer
+            index: value returned by index_payload
+
+        Returns:
+            TAG: tag with the payload
+        """
+        return cls.load_payload(raw_data, [index])
 
+    @classmethod
+    def _deferred(cls, raw_data, index):
+        """ Creates a tag whose payload is decoded on first access. """
+        self = cls._trusted(None)
+        self._lazy = (raw_data, index)
         return self
 
+    def _load_lazy(self):
+        """ Decodes the payload of a lazily loaded tag. """
+        raw_data, offset = self._lazy
+        self._lazy = None
+        self._payload = self.load_payload(raw_data, [offset])._payload
+
     def write_tag(self, buffer_):
         buffer_.write(bytes([self.tag_type]))
 
     def write_name(self, buffer_):
         if self.name is not None:
-            encoded = self.name.encode('utf-8')
-            buffer_.write(struct.pack(">h%ds" %
-                                      (len(encoded),), len(encoded), encoded))
+            write_string(buffer_, self.name)
 
     def write_payload(self, buffer_):
         buffer_.write(self.payload_format.pack(self.payload))
@@ -108,8 +205,10 @@ class TAG_Byte(TAG):
         payload (int): data associated with the tag
     """
     tag_type = TAG_BYTE
+    __slots__ = ()
     payload_type = int
     payload_format = struct.Struct(">B")
+    dtype = np.dtype('>u1')
 
 
 class TAG_Short(TAG):
@@ -120,8 +219,10 @@ class TAG_Short(TAG):
         payload (int): data associated with the tag
     """
     tag_type = TAG_SHORT
+    __slots__ = ()
     payload_type = int
     payload_format = struct.Struct(">h")
+    dtype = np.dtype('>i2')
 
 
 class TAG_Int(TAG):
@@ -132,8 +233,10 @@ class TAG_Int(TAG):
         payload (int): data associated with the tag
     """
     tag_type = TAG_INT
+    __slots__ = ()
     payload_type = int
     payload_format = struct.Struct(">i")
+    dtype = np.dtype('>i4')
 
 
 class TAG_Long(TAG):
@@ -144,8 +247,10 @@ class TAG_Long(TAG):
         payload (int): data associated with the tag
     """
     tag_type = TAG_LONG
+    __slots__ = ()
     payload_type = int
     payload_format = struct.Struct(">q")
+    dtype = np.dtype('>i8')
 
 
 class TAG_Float(TAG):
@@ -156,8 +261,10 @@ class TAG_Float(TAG):
         payload (float): data associated with the tag
     """
     tag_type = TAG_FLOAT
+    __slots__ = ()
     payload_type = float
     payload_format = struct.Struct(">f")
+    dtype = np.dtype('>f4')
 
 
 class TAG_Double(TAG):
@@ -168,8 +275,10 @@ class TAG_Double(TAG):
         payload (float): data associated with the tag
     """
     tag_type = TAG_DOUBLE
+    __slots__ = ()
     payload_type = float
     payload_format = struct.Struct(">d")
+    dtype = np.dtype('>f8')
 
 
 class TAG_Array(TAG):
@@ -179,6 +288,8 @@ class TAG_Array(TAG):
         name (str): name of the tag
         payload (np.ndarray): data associated with the tag
     """
+    __slots__ = ()
+
     def __init__(self, payload=None, name=""):
         if payload is None:
             payload = np.zeros(0, self.dtype)
@@ -195,7 +306,7 @@ class TAG_Array(TAG):
         Sets the offset to the end of the payload.
 
         Args:
-            raw_data (np.ndarray): byte array
+            raw_data (memoryview): byte buffer
             data_offset (List[int]): offset in the raw data expressed in number of
                 bytes, it is a list because it has to be a mutable object in
                 order to pass it by reference
@@ -203,20 +314,30 @@ class TAG_Array(TAG):
         Returns:
             TAG: tag with the payload
         """
-        data = raw_data[data_offset[0]:]
-        (string_len,) = TAG_Int.payload_format.unpack_from(data)
+        (array_len,) = TAG_Int.payload_format.unpack_from(
+            raw_data, data_offset[0])
         # Offset it by 4 bytes, because first it reads the length of the
         # array (4 bytes), then reads length number of array elements
-        payload = np.fromstring(
-            data[4:string_len * cls.dtype.itemsize + 4], cls.dtype)
-        self = cls(payload)
-        data_offset[0] += string_len * cls.dtype.itemsize + 4
+        payload = np.frombuffer(raw_data, cls.dtype, count=array_len,
+                                offset=data_offset[0] + 4).copy()
+        self = cls._trusted(payload)
+        data_offset[0] += array_len * cls.dtype.itemsize + 4
         return self
 
+    @classmethod
+    def skip_payload(cls, raw_data, data_offset):
+        (array_len,) = TAG_Int.payload_format.unpack_from(
+            raw_data, data_offset[0])
+        data_offset[0] += array_len * cls.dtype.itemsize + 4
+
+    @classmethod
+    def from_index(cls, raw_data, index):
+        return cls._deferred(raw_data, index)
+
     def write_payload(self, buffer_):
-        payload_str = self.payload.tostring()
-        buffer_.write(struct.pack(">I%ds" % (len(payload_str),),
-                                  self.payload.size, payload_str))
+        payload = np.ascontiguousarray(self.payload, self.dtype)
+        buffer_.write(array_length_format.pack(payload.size))
+        buffer_.write(memoryview(payload).cast('B'))
 
 
 
@@ -228,6 +349,7 @@ class TAG_Byte_Array(TAG_Array):
         payload (np.ndarray): data associated with the tag
     """
     tag_type = TAG_BYTE_ARRAY
+    __slots__ = ()
     dtype = np.dtype('uint8')
 
 
@@ -239,6 +361,7 @@ class TAG_Int_Array(TAG_Array):
         payload (np.ndarray): data associated with the tag
     """
     tag_type = TAG_INT_ARRAY
+    __slots__ = ()
     dtype = np.dtype('>u4')
 
 
@@ -250,6 +373,7 @@ class TAG_Long_Array(TAG_Array):
         payload (np.ndarray): data associated with the tag
     """
     tag_type = TAG_LONG_ARRAY
+    __slots__ = ()
     dtype = np.dtype('>q')
 
 
@@ -261,6 +385,7 @@ class TAG_String(TAG):
         payload (str): data associated with the tag
     """
     tag_type = TAG_STRING
+    __slots__ = ()
 
     @classmethod
     def load_payload(cls, raw_data, data_offset):
@@ -269,7 +394,7 @@ class TAG_String(TAG):
         Sets the offset to the end of the payload.
 
         Args:
-            raw_data (np.ndarray): byte array
+            raw_data (memoryview): byte buffer
             data_offset (List[int]): offset in the raw data expressed in number of
                 bytes, it is a list because it has to be a mutable object in
                 order to pass it by reference
@@ -278,9 +403,15 @@ class TAG_String(TAG):
             TAG: tag with the payload
         """
         payload = load_string(raw_data, data_offset)
-        self = cls(payload=payload)
+        self = cls._trusted(payload)
         return self
 
+    @classmethod
+    def skip_payload(cls, raw_data, data_offset):
+        (string_length,) = string_length_format.unpack_from(
+            raw_data, data_offset[0])
+        data_offset[0] += 2 + string_length
+
     def payload_type(self, payload):
         if isinstance(payload, str):
             return payload
@@ -288,9 +419,19 @@ class TAG_String(TAG):
             return payload.decode('utf-8')
 
     def write_payload(self, buffer_):
-        encoded = self.payload.encode('utf-8')
-        buffer_.write(struct.pack(">h%ds" %
-                                  (len(encoded),), len(encoded), encoded))
+        write_string(buffer_, self.payload)
+
+
+def write_string(buffer_, string):
+    """ Writes a length prefixed UTF-8 string.
+
+    Args:
+        buffer_: writable binary stream
+        string (str): the string to write
+    """
+    encoded = string.encode('utf-8')
+    buffer_.write(string_length_format.pack(len(encoded)))
+    buffer_.write(encoded)
 
 
 def load_string(raw_data, data_offset):
@@ -299,7 +440,7 @@ def load_string(raw_data, data_offset):
     Sets the offset to the end of the payload.
 
     Args:
-        raw_data (np.ndarray): byte array
+        raw_data (memoryview): byte buffer
         data_offset (List[int]): offset in the raw data expressed in number of
             bytes, it is a list because it has to be a mutable object in
             order to pass it by reference
@@ -307,11 +448,11 @@ def load_string(raw_data, data_offset):
     Returns:
         str: decoded string
     """
-    data = raw_data[data_offset[0]:]
-    string_length_format = struct.Struct(">H")
-    (string_length,) = string_length_format.unpack_from(data)
-    data_offset[0] += 2 + string_length
-    return data[2:2 + string_length].decode('utf-8')
+    start = data_offset[0] + 2
+    (string_length,) = string_length_format.unpack_from(
+        raw_data, data_offset[0])
+    data_offset[0] = start + string_length
+    return str(raw_data[start:start + string_length], 'utf-8')
 
 
 class TAG_Compound(TAG):
@@ -319,11 +460,19 @@ class TAG_Compound(TAG):
     
     This array keeps going until a TAG_End is found.
 
+    Besides the payload list the compound keeps an order-preserving index
+    from names to tags, so lookups by name take constant time. The index is
+    updated when the payload is set or when tags are added with ``append``
+    or ``__setitem__``. The payload list drops the index when it is
+    modified in place, and renaming a tag drops the index of every
+    compound, so it is rebuilt on the next lookup.
+
     Args:
         name (str): name of the tag
         payload (List[TAG]): data associated with the tag
     """
     tag_type = TAG_COMPOUND
+    __slots__ = ('_names', '_renames')
 
     def __init__(self, payload=None, name=""):
         if payload is None:
@@ -334,7 +483,9 @@ class TAG_Compound(TAG):
 
     @classmethod
     def load_payload(cls, raw_data, data_offset):
-        self = cls()
+        self = cls._trusted([])
+        payload = self._payload
+        names = self._names
         while data_offset[0] < len(raw_data):
             tag_type = raw_data[data_offset[0]]
 
@@ -345,11 +496,78 @@ class TAG_Compound(TAG):
             name = load_string(raw_data, data_offset)
             tag = tag_type_IDs_to_classes[tag_type].load_payload(
                 raw_data, data_offset)
-            tag.name = name
-            self._payload.append(tag)
+            tag._name = name
+            payload.append(tag)
+            names.setdefault(name, tag)
 
         return self
 
+    @classmethod
+    def _trusted(cls, payload, name=""):
+        self = super(TAG_Compound, cls)._trusted(payload, name)
+        self._names = {}
+        self._renames = TAG._renames
+        return self
+
+    @classmethod
+    def skip_payload(cls, raw_data, data_offset):
+        while data_offset[0] < len(raw_data):
+            tag_type = raw_data[data_offset[0]]
+            data_offset[0] += 1
+            if tag_type == 0:
+                break
+            TAG_String.skip_payload(raw_data, data_offset)
+            tag_type_IDs_to_classes[tag_type].skip_payload(
+                raw_data, data_offset)
+
+    @classmethod
+    def index_payload(cls, raw_data, data_offset):
+        """ Indexes the child tags of the compound.
+
+        Returns:
+            List[tuple]: tag class, name and index of each child tag
+        """
+        entries = []
+        while data_offset[0] < len(raw_data):
+            tag_type = raw_data[data_offset[0]]
+            data_offset[0] += 1
+            if tag_type == 0:
+                break
+            name = load_string(raw_data, data_offset)
+            tag_class = tag_type_IDs_to_classes[tag_type]
+            entries.append(
+                (tag_class, name, tag_class.index_payload(raw_data, data_offset)))
+        return entries
+
+    @classmethod
+    def from_index(cls, raw_data, index):
+        return cls._deferred(raw_data, index)
+
+    def _load_lazy(self):
+        raw_data, entries = self._lazy
+        self._lazy = None
+        payload = []
+        for tag_class, name, index in entries:
+            tag = tag_class.from_index(raw_data, index)
+            tag._name = name
+            payload.append(tag)
+        self._payload = payload
+        self._index_names()
+
+    @property
+    def payload(self):
+        if self._lazy is not None:
+            self._load_lazy()
+        if type(self._payload) is not _CompoundPayload:
+            # The list is given out, its changes have to drop the index
+            self._payload = _CompoundPayload(self._payload, self)
+        return self._payload
+
+    @payload.setter
+    def payload(self, new_payload):
+        TAG.payload.fset(self, new_payload)
+        self._index_names()
+
     def payload_type(self, payload):
         for t in payload:
             if not isinstance(t, TAG):
@@ -358,20 +576,83 @@ class TAG_Compound(TAG):
                 raise TypeError("TAG_Compound's payload is not TAG element!")
         return list(payload)
 
+    def _index_names(self):
+        """ Rebuilds the name index, the first tag wins for repeated names. """
+        self._names = {}
+        for tag in self._payload:
+            self._names.setdefault(tag.name, tag)
+        self._renames = TAG._renames
+
+    @property
+    def _name_index(self):
+        if self._lazy is not None:
+            self._load_lazy()
+        if self._names is None or self._renames != TAG._renames:
+            self._index_names()
+        return self._names
+
+    def _lookup(self, name):
+        """ Returns the tag with the given name or None. """
+        tag = self._name_index.get(name)
+        if tag is not None and tag.name != name:
+            # A tag without a name was renamed
+            self._index_names()
+            tag = self._names.get(name)
+        return tag
+
+    def append(self, tag):
+        """ Adds a tag to the end of the payload.
+
+        Args:
+            tag (TAG): the tag to add
+        """
+        self.payload_type([tag])
+        names = self._name_index
+        list.append(self._payload, tag)
+        names.setdefault(tag.name, tag)
+
+    def get(self, name, default=None):
+        """ Returns the tag with the given name or the default value. """
+        tag = self._lookup(name)
+        return default if tag is None else tag
+
+    def keys(self):
+        """ Names of the tags in the payload in order. """
+        return self._name_index.keys()
+
+    def items(self):
+        """ Name and tag pairs of the payload in order. """
+        return self._name_index.items()
+
+    def __contains__(self, name):
+        return self._lookup(name) is not None
+
     def __getitem__(self, name):
-        matching_tag = None
-        for tag in self.payload:
-            if tag.name == name:
-                matching_tag = tag
-                break
+        matching_tag = self._lookup(name)
         if matching_tag is None:
             raise KeyError(
                 "Tag with name \"{}\" not found in payload".format(str(name)))
         else:
             return matching_tag
 
+    def __setitem__(self, name, tag):
+        """ Replaces the tag with the same name in place or appends it. """
+        self.payload_type([tag])
+        tag.name = name
+        old_tag = self._lookup(name)
+        if old_tag is None:
+            self.append(tag)
+        else:
+            payload = self._payload
+            list.__setitem__(
+                payload,
+                next(i for i, t in enumerate(payload) if t is old_tag), tag)
+            self._names[name] = tag
+
     def write_payload(self, buffer_):
-        for tag in self.payload:
+        if self._lazy is not None:
+            self._load_lazy()
+        for tag in self._payload:
             tag.write_tag(buffer_)
             tag.write_name(buffer_)
             tag.write_payload(buffer_)
@@ -379,8 +660,51 @@ class TAG_Compound(TAG):
         buffer_.write(bytes([TAG_END]))
 
 
+class _CompoundPayload(list):
+    """ Payload list of a compound that drops the compound's name index when
+    it is modified in place. """
+    __slots__ = ('_compound',)
+
+    def __init__(self, payload, compound):
+        super(_CompoundPayload, self).__init__(payload)
+        self._compound = compound
+
+    def __reduce__(self):
+        # Copied and pickled as a plain list, the compound wraps it again
+        return list, (list(self),)
+
+
+def _dropping_index(method):
+    def wrapper(self, *args, **kwargs):
+        self._compound._names = None
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for _method in ('__setitem__', '__delitem__', '__iadd__', '__imul__',
+                'append', 'extend', 'insert', 'pop', 'remove', 'clear',
+                'sort', 'reverse'):
+    setattr(_CompoundPayload, _method,
+            _dropping_index(getattr(list, _method)))
+
+
 class TAG_List(TAG):
+    """ A sequential list of unnamed tags of the same type.
+
+    Lists of numeric elements (bytes, shorts, ints, longs, floats and
+    doubles) are decoded into a single big-endian numpy array, available as
+    ``array``. The per-element TAG objects of ``payload`` are only created
+    when the payload or an element is accessed, after which the list is
+    stored as TAG objects again, so modifying an element is kept.
+
+    Args:
+        name (str): name of the tag
+        payload (List[TAG]): data associated with the tag
+    """
     tag_type = TAG_LIST
+    __slots__ = ('_array', 'element_type')
 
     def __init__(self, payload=None, name=""):
         if payload is None:
@@ -389,18 +713,98 @@ class TAG_List(TAG):
             self.payload = payload
         self.name = name
 
+    @property
+    def payload(self):
+        if self._lazy is not None:
+            self._load_lazy()
+        if self._array is not None:
+            element_class = tag_type_IDs_to_classes[self.element_type]
+            self._payload = [element_class._trusted(value)
+                             for value in self._array.tolist()]
+            self._array = None
+        return self._payload
+
+    @payload.setter
+    def payload(self, new_payload):
+        TAG.payload.fset(self, new_payload)
+        self._array = None
+
+    @property
+    def array(self):
+        """ np.ndarray: the elements of a numeric list """
+        if self._lazy is not None:
+            self._load_lazy()
+        if self._array is None:
+            dtype = tag_type_IDs_to_classes[self.element_type].dtype
+            self._array = np.array(
+                [element.payload for element in self._payload], dtype)
+            self._payload = None
+        return self._array
+
+    @array.setter
+    def array(self, new_array):
+        self._lazy = None
+        self._array = np.asarray(
+            new_array, tag_type_IDs_to_classes[self.element_type].dtype)
+        self._payload = None
+
     @classmethod
     def load_payload(cls, raw_data, data_offset):
-        self = cls()
+        self = cls._trusted([])
         self.element_type = TAG_Byte.load_payload(
             raw_data, data_offset).payload
         size = TAG_Int.load_payload(raw_data, data_offset).payload
+        if size == 0:
+            return self
+        element_class = tag_type_IDs_to_classes[self.element_type]
+        if hasattr(element_class, 'payload_format'):
+            # Numeric lists are decoded at once
+            self._array = np.frombuffer(
+                raw_data, element_class.dtype, count=size,
+                offset=data_offset[0]).copy()
+            self._payload = None
+            data_offset[0] += size * element_class.dtype.itemsize
+            return self
         for _ in range(size):
-            element = tag_type_IDs_to_classes[self.element_type].load_payload(
-                raw_data, data_offset)
+            element = element_class.load_payload(raw_data, data_offset)
             self._payload.append(element)
         return self
 
+    @classmethod
+    def _trusted(cls, payload, name=""):
+        self = super(TAG_List, cls)._trusted(payload, name)
+        self._array = None
+        return self
+
+    @classmethod
+    def skip_payload(cls, raw_data, data_offset):
+        element_type = raw_data[data_offset[0]]
+        (size,) = TAG_Int.payload_format.unpack_from(
+            raw_data, data_offset[0] + 1)
+        data_offset[0] += 5
+        if size == 0:
+            return
+        element_class = tag_type_IDs_to_classes[element_type]
+        if hasattr(element_class, 'payload_format'):
+            # Fixed size elements can be skipped at once
+            data_offset[0] += size * element_class.payload_format.size
+        else:
+            for _ in range(size):
+                element_class.skip_payload(raw_data, data_offset)
+
+    @classmethod
+    def from_index(cls, raw_data, index):
+        self = cls._deferred(raw_data, index)
+        self.element_type = raw_data[index]
+        return self
+
+    def _load_lazy(self):
+        raw_data, offset = self._lazy
+        self._lazy = None
+        loaded = self.load_payload(raw_data, [offset])
+        self._payload = loaded._payload
+        self._array = loaded._array
+
     def payload_type(self, payload):
         for item in payload:
             if not isinstance(item, tag_type_IDs_to_classes[self.element_type]):
@@ -411,7 +815,16 @@ class TAG_List(TAG):
         return self.payload[index]
 
     def write_payload(self, buffer_):
+        if self._lazy is not None:
+            self._load_lazy()
         buffer_.write(bytes([self.element_type]))
+        if self._array is not None:
+            array = np.ascontiguousarray(
+                self._array,
+                tag_type_IDs_to_classes[self.element_type].dtype)
+            buffer_.write(TAG_Int.payload_format.pack(array.size))
+            buffer_.write(memoryview(array).cast('B'))
+            return
         buffer_.write(TAG_Int.payload_format.pack(len(self.payload)))
         for i in self.payload:
             i.write_payload(buffer_)
@@ -441,36 +854,421 @@ def printNBTTree(root_tag, level=0):
     return output_string
 
 
-def load(file):
-    with gzip.GzipFile(fileobj=file, mode='rb') as g_file:
-        raw_data = g_file.read()
-        if isinstance(raw_data, str):
-            raw_data = np.fromstring(raw_data, 'uint8')
+def load(file, lazy=False):
+    """ Loads an NBT tree from a gzip compressed file.
+
+    Uncompressed NBT data is detected and read as well.
+
+    The decompressed data is wrapped into a single memoryview, and every tag
+    is decoded directly from it by advancing a shared offset, so the
+    parsing time is linear in the size of the file.
+
+    In lazy mode a single pass only indexes the offsets, types and names of
+    the tags. Scalars and strings are decoded right away, but the payloads
+    of arrays, lists and compounds are decoded on their first access. Lazy
+    tags keep a reference to the decompressed data until then.
+
+    Args:
+        file: binary file object
+        lazy (bool): defer decoding of the large payloads
+
+    Returns:
+        TAG_Compound: the root tag
+    """
+    with open_stream(file) as g_file:
+        raw_data = memoryview(g_file.read())
         data_offset = [1]
         tag_name = load_string(raw_data, data_offset)
-        tag = TAG_Compound.load_payload(raw_data, data_offset)
+        if lazy:
+            tag = TAG_Compound.from_index(
+                raw_data, TAG_Compound.index_payload(raw_data, data_offset))
+        else:
+            tag = TAG_Compound.load_payload(raw_data, data_offset)
         tag.name = tag_name
     return tag
 
 
+class _StreamReader(object):
+    """ Reads exact amounts of bytes from a binary stream.
+
+    Args:
+        stream: binary file object, for example a GzipFile
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        # If it is a bytearray, the bytes read are appended to it
+        self.capture = None
+
+    def read(self, size):
+        """ Reads exactly size bytes.
+
+        Raises:
+            EOFError: if the stream ends before
+        """
+        data = self.stream.read(size)
+        while len(data) < size:
+            more = self.stream.read(size - len(data))
+            if not more:
+                raise EOFError("Unexpected end of NBT data!")
+            data += more
+        if self.capture is not None:
+            self.capture += data
+        return data
+
+    def unpack(self, format_):
+        """ Reads and unpacks a single value with a struct.Struct. """
+        (value,) = format_.unpack(self.read(format_.size))
+        return value
+
+    def read_string(self):
+        length = self.unpack(string_length_format)
+        return self.read(length).decode('utf-8')
+
+    def skip(self, size):
+        """ Consumes size bytes without keeping them. """
+        while size > 0:
+            size -= len(self.read(min(size, 1 << 16)))
+
+    def skip_payload(self, tag_type):
+        """ Consumes the payload of a tag without building it. """
+        tag_class = tag_type_IDs_to_classes[tag_type]
+        if tag_type == TAG_COMPOUND:
+            while True:
+                child_type = self.unpack(TAG_Byte.payload_format)
+                if child_type == TAG_END:
+                    break
+                self.skip(self.unpack(string_length_format))
+                self.skip_payload(child_type)
+        elif tag_type == TAG_LIST:
+            element_type = self.unpack(TAG_Byte.payload_format)
+            size = self.unpack(TAG_Int.payload_format)
+            if size == 0:
+                return
+            element_class = tag_type_IDs_to_classes[element_type]
+            if hasattr(element_class, 'payload_format'):
+                self.skip(size * element_class.payload_format.size)
+            else:
+                for _ in range(size):
+                    self.skip_payload(element_type)
+        elif tag_type == TAG_STRING:
+            self.skip(self.unpack(string_length_format))
+        elif issubclass(tag_class, TAG_Array):
+            self.skip(self.unpack(TAG_Int.payload_format)
+                      * tag_class.dtype.itemsize)
+        else:
+            self.skip(tag_class.payload_format.size)
+
+    def load_payload(self, tag_type):
+        """ Reads the payload of a tag and builds the tag. """
+        self.capture = bytearray()
+        try:
+            self.skip_payload(tag_type)
+            raw_data = memoryview(self.capture)
+        finally:
+            self.capture = None
+        return tag_type_IDs_to_classes[tag_type].load_payload(raw_data, [0])
+
+
+def iterparse(file, chunk_size=1 << 20):
+    """ Parses an NBT file incrementally.
+
+    The decompressed data is pulled from the stream while iterating, so the
+    memory usage is bounded by chunk_size instead of the size of the file.
+
+    Every tag produces an event ``(path, tag_type, name, value)``, where path
+    is the slash separated list of names leading to the tag from the root
+    (the root itself has the path ``""``). Elements of lists are named by
+    their index.
+
+    * Scalars and strings produce a single event with their value.
+    * Arrays produce one or more events, each with a numpy array holding
+      the next chunk of at most chunk_size bytes of elements.
+    * Compounds produce an event with value ``None`` when they start,
+      lists with value ``(element_type, size)``, and both produce a
+      ``TAG_END`` event with the same path and name when they end.
+
+    Args:
+        file: binary file object
+        chunk_size (int): maximal size of array chunks in bytes
+
+    Yields:
+        tuple: path, tag type, name and value of the events
+    """
+    with open_stream(file) as g_file:
+        reader = _StreamReader(g_file)
+        tag_type = reader.unpack(TAG_Byte.payload_format)
+        if tag_type != TAG_COMPOUND:
+            raise ValueError("The root tag should be a TAG_Compound!")
+        name = reader.read_string()
+        for event in _iter_payload(reader, tag_type, '', name, chunk_size):
+            yield event
+
+
+def _iter_payload(reader, tag_type, path, name, chunk_size):
+    """ Generates the events of a single tag, see iterparse. """
+    tag_class = tag_type_IDs_to_classes[tag_type]
+    if tag_type == TAG_COMPOUND:
+        yield (path, tag_type, name, None)
+        prefix = path + '/' if path else ''
+        while True:
+            child_type = reader.unpack(TAG_Byte.payload_format)
+            if child_type == TAG_END:
+                break
+            child_name = reader.read_string()
+            for event in _iter_payload(reader, child_type,
+                                       prefix + child_name, child_name,
+                                       chunk_size):
+                yield event
+        yield (path, TAG_END, name, None)
+    elif tag_type == TAG_LIST:
+        element_type = reader.unpack(TAG_Byte.payload_format)
+        size = reader.unpack(TAG_Int.payload_format)
+        yield (path, tag_type, name, (element_type, size))
+        prefix = path + '/' if path else ''
+        for idx in range(size):
+            for event in _iter_payload(reader, element_type,
+                                       prefix + str(idx), str(idx),
+                                       chunk_size):
+                yield event
+        yield (path, TAG_END, name, None)
+    elif tag_type == TAG_STRING:
+        yield (path, tag_type, name, reader.read_string())
+    elif issubclass(tag_class, TAG_Array):
+        remaining = reader.unpack(TAG_Int.payload_format)
+        itemsize = tag_class.dtype.itemsize
+        chunk_len = max(chunk_size // itemsize, 1)
+        if remaining == 0:
+            yield (path, tag_type, name, np.zeros(0, tag_class.dtype))
+        while remaining > 0:
+            count = min(chunk_len, remaining)
+            chunk = np.frombuffer(reader.read(count * itemsize),
+                                  tag_class.dtype)
+            remaining -= count
+            yield (path, tag_type, name, chunk)
+    else:
+        yield (path, tag_type, name, reader.unpack(tag_class.payload_format))
+
+
+def query(file, paths):
+    """ Reads selected tags from an NBT file.
+
+    The data is read as a stream, tags are only built if their path matches
+    one of the requested paths, every other subtree and array is skipped by
+    its length. This is much faster than loading the whole file when only a
+    few values are needed.
+
+    Paths are slash separated names starting below the root tag, elements
+    of lists are named by their index. A ``*`` or ``?`` in a name matches
+    like in shell patterns, for example ``"Palette/*"`` returns every tag of
+    the palette. A matching tag is returned with its whole subtree.
+
+    Args:
+        file: binary file object
+        paths (List[str]): paths of the requested tags
+
+    Returns:
+        dict: the matching tags by their path, in the order of the file
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    patterns = [path.strip('/').split('/') for path in paths]
+    found = {}
+    with open_stream(file) as g_file:
+        reader = _StreamReader(g_file)
+        tag_type = reader.unpack(TAG_Byte.payload_format)
+        if tag_type != TAG_COMPOUND:
+            raise ValueError("The root tag should be a TAG_Compound!")
+        reader.skip(reader.unpack(string_length_format))
+        _query_payload(reader, TAG_COMPOUND, [], patterns, found)
+    return found
+
+
+def _match_segment(pattern, name):
+    if '*' in pattern or '?' in pattern:
+        return fnmatch.fnmatchcase(name, pattern)
+    return pattern == name
+
+
+def _query_payload(reader, tag_type, path, patterns, found):
+    """ Collects the matching children of a compound or list into found. """
+    depth = len(path) + 1
+    patterns = [p for p in patterns if len(p) >= depth]
+
+    def visit(child_type, child_name):
+        child_path = path + [child_name]
+        matching = [p for p in patterns
+                    if _match_segment(p[depth - 1], child_name)]
+        if any(len(p) == depth for p in matching):
+            tag = reader.load_payload(child_type)
+            if tag_type == TAG_COMPOUND:
+                tag._name = child_name
+            found['/'.join(child_path)] = tag
+        elif matching and child_type in (TAG_COMPOUND, TAG_LIST):
+            _query_payload(reader, child_type, child_path, matching, found)
+        else:
+            reader.skip_payload(child_type)
+
+    if tag_type == TAG_COMPOUND:
+        while True:
+            child_type = reader.unpack(TAG_Byte.payload_format)
+            if child_type == TAG_END:
+                break
+            visit(child_type, reader.read_string())
+    else:
+        element_type = reader.unpack(TAG_Byte.payload_format)
+        size = reader.unpack(TAG_Int.payload_format)
+        for idx in range(size):
+            visit(element_type, str(idx))
+
+
+
+# Size of the write buffer used by save
+buffer_size = 1 << 16
+
+
+def save(root_tag, file, compresslevel=9, workers=None):
+    """ Saves an NBT tree into a file.
+
+    The tags are serialized straight through the compressor into the file,
+    small writes are collected in a buffer of buffer_size bytes.
 
-def save(root_tag, file):
+    Args:
+        root_tag (TAG_Compound): the root tag
+        file: writable binary file object
+        compresslevel (int): gzip compression level from 0 (no compression)
+            to 9 (slowest, smallest), or None to write uncompressed NBT data
+        workers (int): number of threads compressing in parallel, see
+            ParallelGzipWriter, by default a single GzipFile is used
+    """
     if root_tag.name is None:
         root_tag.name = ""
 
-    buffer_ = io.BytesIO()
-    root_tag.write_tag(buffer_)
-    root_tag.write_name(buffer_)
-    root_tag.write_payload(buffer_)
-    data = buffer_.getvalue()
+    if compresslevel is None:
+        stream = file
+    elif workers is not None:
+        stream = ParallelGzipWriter(file, compresslevel=compresslevel,
+                                    workers=workers)
+    else:
+        stream = gzip.GzipFile(fileobj=file, mode='wb',
+                               compresslevel=compresslevel)
+    buffer_ = io.BufferedWriter(stream, buffer_size)
+    try:
+        root_tag.write_tag(buffer_)
+        root_tag.write_name(buffer_)
+        root_tag.write_payload(buffer_)
+    finally:
+        try:
+            # Detaching flushes the buffer without closing the file, even
+            # if serializing failed, the buffer would close it when it is
+            # garbage collected
+            buffer_.detach()
+        finally:
+            if compresslevel is not None:
+                stream.close()
+
+
+# Size of the uncompressed blocks compressed by a ParallelGzipWriter
+parallel_block_size = 1 << 17
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """ Gzip compressor that compresses blocks of data on multiple threads.
+
+    The data is split into blocks of parallel_block_size bytes, which are
+    compressed independently on a thread pool (zlib releases the GIL), using
+    the last 32 KiB of the previous block as a preset dictionary. Every
+    block but the last one ends with a sync flush, so the concatenated
+    blocks form a single, ordinary gzip member, like the output of pigz.
+
+    Args:
+        file: writable binary file object
+        compresslevel (int): compression level from 0 to 9
+        workers (int): number of compressing threads
+    """
+
+    def __init__(self, file, compresslevel=9, workers=4):
+        super(ParallelGzipWriter, self).__init__()
+        self._file = file
+        self._level = compresslevel
+        self._workers = max(int(workers), 1)
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._workers)
+        self._pending = collections.deque()
+        self._block = bytearray()
+        self._dictionary = None
+        self._crc = 0
+        self._size = 0
+        # Header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        self._file.write(GZIP_MAGIC + b'\x08\x00\x00\x00\x00\x00\x00\xff')
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._block += data
+        while len(self._block) >= parallel_block_size:
+            self._submit(bytes(self._block[:parallel_block_size]), False)
+            del self._block[:parallel_block_size]
+        return len(data)
+
+    def _submit(self, block, last):
+        self._pending.append(self._executor.submit(
+            self._compress, block, self._dictionary, last))
+        self._dictionary = block[-(1 << 15):]
+        # Bounding the number of blocks in memory
+        while len(self._pending) > 2 * self._workers:
+            self._file.write(self._pending.popleft().result())
+
+    def _compress(self, block, dictionary, last):
+        if dictionary is None:
+            compressor = zlib.compressobj(
+                self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            compressor = zlib.compressobj(
+                self._level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+        return compressor.compress(block) + compressor.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._block), True)
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+            self._file.write(struct.pack(
+                "<II", self._crc & 0xffffffff, self._size & 0xffffffff))
+        finally:
+            self._executor.shutdown()
+            super(ParallelGzipWriter, self).close()
+
+
+@contextlib.contextmanager
+def open_stream(file):
+    """ Opens NBT data for reading.
+
+    Gzip compressed data is decompressed on the fly, uncompressed data is
+    read from the file directly.
 
-    gzio = io.BytesIO()
-    gz = gzip.GzipFile(fileobj=gzio, mode='wb')
-    gz.write(data)
-    gz.close()
-    data = gzio.getvalue()
+    Args:
+        file: readable binary file object
+    """
+    if hasattr(file, 'peek'):
+        magic = file.peek(2)[:2]
+    elif file.seekable():
+        position = file.tell()
+        magic = file.read(2)
+        file.seek(position)
+    else:
+        magic = GZIP_MAGIC
 
-    file.write(data)
+    if magic == GZIP_MAGIC:
+        with gzip.GzipFile(fileobj=file, mode='rb') as g_file:
+            yield g_file
+    else:
+        yield file
 
 
 
@@ -1,12 +1,227 @@
-import math
+import os
 import numpy as np
 
 from creAI.mc import nbt
-from creAI.mc.tilemap import Tilemap
+from creAI.mc.tilemap import Tilemap, index_dtype
 from creAI.mc.tile import Tile
 
 from creAI.mc.exceptions import *
 
+
+def decode_varints(block_data: np.ndarray, count: int) -> np.ndarray:
+    """Decodes the first count varints of a byte array.
+
+    Every value is stored in 7 bit groups, least significant group first,
+    the highest bit of a byte is set if the value continues in the next byte.
+    The decoding is vectorized: the last bytes of the values are found by
+    their clear highest bit, and the 7 bit groups are shifted by their
+    position in the value and summed per value.
+
+    Args:
+        block_data (np.ndarray): Byte array.
+        count (int): Number of values to decode.
+
+    Returns:
+        np.ndarray: The decoded values.
+    """
+    block_data = np.asarray(block_data, dtype=np.uint8)
+    if count == 0:
+        return np.zeros(0, dtype=int)
+    ends = np.flatnonzero(block_data < 128)[:count]
+    _check_block_data(ends.size, count)
+    #Every value fits into a single byte
+    if ends[-1] == count - 1:
+        return block_data[:count].astype(int)
+
+    starts = np.empty(count, dtype=int)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    if lengths.max() > 5:
+        raise ValueError("id_length too big! (Possibly corrupted data)")
+    groups = (block_data[:ends[-1] + 1] & 127).astype(int)
+    shifts = 7 * (np.arange(groups.size) - np.repeat(starts, lengths))
+    return np.add.reduceat(groups << shifts, starts)
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """Encodes non-negative integers as varints.
+
+    The inverse of decode_varints. The encoding is vectorized: the number of
+    bytes is computed for every value, the output is allocated once, then
+    the n-th bytes of all values are written at once with masked shifts.
+
+    Args:
+        values (np.ndarray): Array of integers, it is flattened in C order.
+
+    Returns:
+        np.ndarray: Byte array.
+    """
+    values = np.ravel(values)
+    lengths = np.ones(values.shape, dtype=np.uint8)
+    for i in range(1, 5):
+        lengths += values >= 1 << 7*i
+    offsets = np.cumsum(lengths, dtype=int) - lengths
+    block_data = np.empty(offsets[-1] + lengths[-1] if values.size else 0,
+                          dtype=np.uint8)
+    for i in range(int(lengths.max()) if values.size else 0):
+        if i == 0:
+            mask = slice(None)
+        else:
+            mask = lengths > i
+        group = (values[mask] >> 7*i) & 127
+        group |= (lengths[mask] > i + 1).view(np.uint8) << 7
+        block_data[offsets[mask] + i] = group
+    return block_data
+
+
+def _check_block_data(found, count, numeric_ids=None, palette_max=None,
+                      origin=(0, 0, 0)):
+    """Checks the ids decoded from BlockData.
+
+    Args:
+        found (int): Number of ids found in BlockData.
+        count (int): Number of ids expected.
+        numeric_ids (np.ndarray): Ids of a box of blocks in y, z, x order,
+            they are compared with palette_max if given.
+        palette_max (int): Value of the PaletteMax tag.
+        origin (tuple of int): The x, y, z coordinates of the corner of the
+            box.
+    """
+    if found < count:
+        raise ValueError(
+            "BlockData contains only {} ids instead of {}!".format(
+                found, count)
+        )
+    if numeric_ids is None:
+        return
+    too_big = np.argwhere(numeric_ids > palette_max)
+    if too_big.size:
+        y, z, x = too_big[0]
+        raise ValueError(
+            "Palette ID {} at {} is bigger than PaletteMax {}".format(
+                numeric_ids[y, z, x],
+                (origin[0] + x, origin[1] + y, origin[2] + z),
+                palette_max
+            )
+        )
+
+
+def _palette_from_tag(palette: nbt.TAG_Compound) -> list:
+    """Builds the list of tiles from the Palette tag."""
+    p = [None] * len(palette.payload)
+    for name, tag in palette.items():
+        p[tag.payload] = Tile(name)
+    return p
+
+
+def row_index(block_data: np.ndarray, shape: tuple,
+              cache_pth: str = None) -> np.ndarray:
+    """Finds the BlockData offsets where the rows of blocks start.
+
+    A row is a run of blocks along the x axis, the offset of the row at
+    height y and depth z is at index ``y * length + z``, the last element is
+    the offset of the end of the last row.
+
+    Args:
+        block_data (np.ndarray): BlockData byte array.
+        shape (tuple of int): Width, height and length of the schematic.
+        cache_pth (str): Load the index from this file if it belongs to the
+            same BlockData, otherwise compute and save it there.
+
+    Returns:
+        np.ndarray: The offsets.
+    """
+    w, h, l = shape
+    #Header identifying the BlockData of the index
+    header = np.array([w, h, l, block_data.size], dtype=np.int64)
+    if cache_pth is not None and os.path.isfile(cache_pth):
+        try:
+            cached = np.load(cache_pth)
+        except (OSError, ValueError):
+            cached = None
+        if cached is not None and np.array_equal(cached[:4], header):
+            return cached[4:]
+
+    count = w*h*l
+    if count == 0:
+        rows = np.zeros(h*l + 1, dtype=np.int64)
+    elif block_data.size >= count and block_data[:count].max() < 128:
+        #Every id is a single byte
+        rows = np.arange(0, count + 1, w, dtype=np.int64)
+    else:
+        ends = np.flatnonzero(block_data < 128)[:count]
+        _check_block_data(ends.size, count)
+        rows = np.concatenate(([0], ends[w - 1::w] + 1)).astype(np.int64)
+
+    if cache_pth is not None:
+        try:
+            with open(cache_pth, 'wb') as cache_file:
+                np.save(cache_file, np.concatenate((header, rows)))
+        except OSError:
+            #The cache is optional, read-only directories are fine
+            pass
+    return rows
+
+
+#Size in bytes of the BlockData chunks decoded at once by
+#Schematic.load(stream=True), it doesn't depend on the dimensions because
+#the reader is set up before the Width and Length tags are read
+stream_chunk_size = 1 << 16
+
+
+class _BlockDataDecoder(object):
+    """Decodes BlockData chunk by chunk into a preallocated array.
+
+    Varints split between two chunks are completed with the next chunk.
+
+    Args:
+        root_tag (nbt.TAG_Compound): Tag with the dimensions and PaletteMax.
+    """
+
+    def __init__(self, root_tag):
+        self.shape = (root_tag["Width"].payload,
+                      root_tag["Height"].payload,
+                      root_tag["Length"].payload)
+        self.palette_max = root_tag["PaletteMax"].payload
+        self.numeric_ids = np.empty(
+            np.prod(self.shape, dtype=int),
+            dtype=index_dtype(self.palette_max + 1))
+        self.filled = 0
+        self.pending = np.zeros(0, dtype=np.uint8)
+
+    def feed(self, chunk):
+        """Decodes the complete varints of the next chunk of BlockData."""
+        remaining = self.numeric_ids.size - self.filled
+        if remaining == 0:
+            return
+        if self.pending.size:
+            chunk = np.concatenate((self.pending, chunk))
+        ends = np.flatnonzero(chunk < 128)[:remaining]
+        complete = ends[-1] + 1 if ends.size else 0
+        if ends.size < remaining:
+            #Bytes of a varint that continues in the next chunk
+            self.pending = chunk[complete:]
+            if self.pending.size > 4:
+                raise ValueError(
+                    "id_length too big! (Possibly corrupted data)")
+        else:
+            self.pending = np.zeros(0, dtype=np.uint8)
+        if ends.size == 0:
+            return
+        self.numeric_ids[self.filled:self.filled + ends.size] = \
+            decode_varints(chunk[:complete], ends.size)
+        self.filled += ends.size
+
+    def finish(self):
+        """Returns the ids as a (w, h, l) view of the (h, l, w) array."""
+        w, h, l = self.shape
+        numeric_ids = self.numeric_ids.reshape((h, l, w))
+        _check_block_data(self.filled, self.numeric_ids.size, numeric_ids,
+                          self.palette_max)
+        return numeric_ids.transpose((2, 0, 1))
+
+
 class Schematic(Tilemap):
     """Minecraft schematics.
 
@@ -29,16 +244,11 @@ class Schematic(Tilemap):
         }
 
         for name, tag_class in required_tags.items():
-            found = False
-            for tag in root.payload:
-                if tag.name == name:
-                    if isinstance(tag, tag_class):
-                        found = True
-                    else:
-                        raise InvalidNBTTagType(name, tag_class)
-
-            if not found:
+            tag = root.get(name)
+            if tag is None:
                 raise MissingNBTTag(name)
+            if not isinstance(tag, tag_class):
+                raise InvalidNBTTagType(name, tag_class)
 
         if root["DataVersion"].payload < 1976:
             raise ValueError("Schematic DataVersion should be at least 1976!")
@@ -51,80 +261,173 @@ class Schematic(Tilemap):
         
 
     @classmethod
-    def load(cls, file, version):
+    def load(cls, file, version, stream=False):
         """Builds a tilemap based on the NBT structure.
+
+        Args:
+            file: Readable binary file object.
+            version (str): Minecraft version of the tiles.
+            stream (bool): Decode BlockData while reading the file, in
+                chunks of stream_chunk_size bytes, into an array of the
+                smallest integer type that fits PaletteMax. The whole NBT tree and BlockData
+                are never held in memory, so the peak memory usage is close
+                to the size of the result.
         """
+        if stream:
+            return cls._load_stream(file, version)
+
         root_tag = cls._check_format(nbt.load(file=file))
 
         h = root_tag["Height"].payload
         l = root_tag["Length"].payload
         w = root_tag["Width"].payload
         block_data = root_tag["BlockData"].payload
-        palette = root_tag["Palette"].payload
-
-        numeric_ids = np.empty((w, h, l), dtype=int)
-        data_offset = 0
-
-        #Extracting numeric ids from binary data
-        for block in range(h*l*w):
-            numeric_id = 0
-            id_length = 0
-            while True:
-                next_byte = block_data[data_offset]
-                next_byte -= next_byte & 128
-                numeric_id = numeric_id | (next_byte << id_length*7)
-                id_length += 1
-                if id_length > 5:
-                    raise Exception(
-                        "id_length too big! (Possibly corrupted data)"
-                    )
-                if ((block_data[data_offset] & 128) != 128):
-                    data_offset += 1
-                    break
-                data_offset += 1
-            y = block // (w * l)
-            z = (block % (w * l)) // w
-            x = (block % (w * l)) % w
-            if numeric_id > root_tag["PaletteMax"].payload:
+        palette = root_tag["Palette"]
+
+        palette_max = root_tag["PaletteMax"].payload
+
+        #Extracting numeric ids from binary data, blocks are stored in
+        #y, z, x order
+        numeric_ids = decode_varints(block_data, h*l*w).reshape((h, l, w))
+        _check_block_data(numeric_ids.size, h*l*w, numeric_ids, palette_max)
+        numeric_ids = numeric_ids.astype(index_dtype(palette_max + 1))
+
+        data = numeric_ids.transpose((2, 0, 1))
+        return cls(data=data, palette=_palette_from_tag(palette),
+                   version=version)
+
+    @classmethod
+    def _load_stream(cls, file, version):
+        """Builds a tilemap from the events of nbt.iterparse.
+
+        Every top level tag but BlockData is collected into a root tag that
+        is checked like a loaded schematic. BlockData is decoded as soon as
+        its chunks arrive if the dimensions and PaletteMax are already
+        known, which is the case for schematics written by creAI and
+        WorldEdit, otherwise its bytes are kept until the end of the file.
+        """
+        root_tag = nbt.TAG_Compound(name='Schematic')
+        decoder = None
+        chunks = []
+        header = ('Width', 'Height', 'Length', 'PaletteMax')
+        for path, tag_type, name, value in nbt.iterparse(
+                file, chunk_size=stream_chunk_size):
+            if path == 'BlockData' and tag_type == nbt.TAG_BYTE_ARRAY:
+                if 'BlockData' not in root_tag:
+                    root_tag.append(nbt.TAG_Byte_Array(name='BlockData'))
+                    if all(t in root_tag for t in header):
+                        decoder = _BlockDataDecoder(root_tag)
+                if decoder is not None:
+                    decoder.feed(value)
+                else:
+                    chunks.append(value)
+            elif path == 'Palette/' + name and tag_type == nbt.TAG_INT \
+                    and isinstance(root_tag.get('Palette'), nbt.TAG_Compound):
+                root_tag['Palette'].append(
+                    nbt.TAG_Int(name=name, payload=value))
+            elif path == name and tag_type != nbt.TAG_END \
+                    and name not in root_tag:
+                tag_class = nbt.tag_type_IDs_to_classes[tag_type]
+                if tag_type in (nbt.TAG_COMPOUND, nbt.TAG_LIST) \
+                        or issubclass(tag_class, nbt.TAG_Array):
+                    #Only the type of these tags is checked
+                    root_tag.append(tag_class(name=name))
+                else:
+                    root_tag.append(tag_class(name=name, payload=value))
+
+        root_tag = cls._check_format(root_tag)
+        if decoder is None:
+            decoder = _BlockDataDecoder(root_tag)
+            for chunk in chunks:
+                decoder.feed(chunk)
+        data = decoder.finish()
+        return cls(data=data, palette=_palette_from_tag(root_tag['Palette']),
+                   version=version)
+
+    @classmethod
+    def load_region(cls, file, origin, size, version, cache=False):
+        """Builds a tilemap from a box of the schematic.
+
+        Only the varints inside the box are decoded, Y-slabs outside of it
+        are skipped entirely. To find the varints a sparse index of the
+        BlockData offsets where the rows (runs of Width blocks along the x
+        axis) start is built, see row_index. With cache the index is saved
+        next to the schematic file as ``<file name>.rows.npy``, so later
+        crops of the same file skip this step.
+
+        Args:
+            file: Readable binary file object.
+            origin (tuple of int): The x, y, z coordinates of the corner of
+                the box.
+            size (tuple of int): The width, height and length of the box.
+            version (str): Minecraft version of the tiles.
+            cache (bool): Load or save the row index next to the file, if
+                the file object has a name. Off by default, so nothing is
+                written next to the user's files.
+        """
+        root_tag = cls._check_format(nbt.load(file=file, lazy=True))
+        w = root_tag["Width"].payload
+        h = root_tag["Height"].payload
+        l = root_tag["Length"].payload
+        palette_max = root_tag["PaletteMax"].payload
+        block_data = root_tag["BlockData"].payload
+
+        x0, y0, z0 = origin
+        sx, sy, sz = size
+        for start, length, dim in zip(origin, size, (w, h, l)):
+            if start < 0 or length < 0 or start + length > dim:
                 raise ValueError(
-                    "Palette ID {} at {} is bigger than PaletteMax {}".format(
-                        numeric_id,
-                        (x, y, z),
-                        root_tag["PaletteMax"].payload
-                    )
-                )
-            numeric_ids[x, y, z] = numeric_id
+                    "Box at {} with size {} is outside of the schematic "
+                    "with size {}!".format(origin, size, (w, h, l)))
 
-        
-        data = numeric_ids
-        p = [None] * len(palette)
-        for tag in palette:
-            p[tag.payload] = Tile(tag.name)
-        palette = p
-        self = cls(data=data, palette=palette, version=version)
-        return self
-
-    def save(self, file):
+        cache_pth = None
+        name = getattr(file, 'name', None)
+        if cache and isinstance(name, str) and os.path.isfile(name):
+            cache_pth = name + '.rows.npy'
+            if os.path.isfile(cache_pth) and \
+                    os.path.getmtime(cache_pth) < os.path.getmtime(name):
+                #The schematic changed since the index was saved
+                os.remove(cache_pth)
+        rows = row_index(block_data, (w, h, l), cache_pth)
+
+        numeric_ids = np.empty(
+            (sy, sz, sx), dtype=index_dtype(palette_max + 1))
+        for y in range(y0, y0 + sy):
+            first_row = y*l + z0
+            slab = block_data[rows[first_row]:rows[first_row + sz]]
+            numeric_ids[y - y0] = decode_varints(
+                slab, sz*w).reshape((sz, w))[:, x0:x0 + sx]
+
+        _check_block_data(numeric_ids.size, numeric_ids.size, numeric_ids,
+                          palette_max, origin)
+
+        return cls(data=numeric_ids.transpose((2, 0, 1)),
+                   palette=_palette_from_tag(root_tag['Palette']),
+                   version=version)
+
+    def save(self, file, compresslevel=9, workers=None):
         """Builds an NBT structure based on the tilemap.
+
+        Args:
+            file: Writable binary file object.
+            compresslevel (int): Gzip compression level, 1 is the fastest, 9
+                is the smallest, None writes uncompressed NBT data.
+            workers (int): Number of threads to compress with, useful for
+                large schematics.
         """
-        # Swapping axes
-        swapped_tile_map = np.swapaxes(self._bd, 0, 1)
-        swapped_tile_map = np.swapaxes(swapped_tile_map, 1, 2)
+        # Blocks are stored in y, z, x order, they are encoded in slabs of
+        # 16 layers, so sparse data is only made dense a slab at a time
+        data = self.data
         # Creating root tag
         root_tag = nbt.TAG_Compound(name='Schematic')
         # Building Palette tag
-        palette_tag = nbt.TAG_Compound(name='Palette')
-        palette_payload = []
-
-        for tile, idx in zip(self._p, range(len(self._p))):
-            int_tag = nbt.TAG_Int(
-                name=tile.id, payload=idx)
-            palette_payload.append(int_tag)
-
-        palette_tag.payload = palette_payload
+        palette = self.palette
+        palette_tag = nbt.TAG_Compound(name='Palette', payload=[
+            nbt.TAG_Int(name=tile.id, payload=idx)
+            for idx, tile in enumerate(palette)])
         # Creating PaletteMax tag
         palette_max_tag = nbt.TAG_Int(
-            name='PaletteMax', payload=len(self._p)-1)
+            name='PaletteMax', payload=len(palette)-1)
         # Creating Width tag
         width_tag = nbt.TAG_Short(
             name='Width', payload=self.shape[0])
@@ -141,20 +444,11 @@ class Schematic(Tilemap):
             name='DataVersion', payload=1976)
         # Creating BlockData tag
         block_data_tag = nbt.TAG_Byte_Array(name='BlockData')
-        bytes_ = []
-        for idx in swapped_tile_map.flat:
-            if (idx == 0):
-                bytes_.append(0)
-                continue
-            id_length = math.ceil(int(idx).bit_length()/7.)
-            for i in range(id_length):
-                next_byte = ((idx >> i*7)
-                             - ((idx >> (i+1)*7) << (i+1)*7))
-                if (i != id_length-1):
-                    next_byte = next_byte | 128
-                bytes_.append(next_byte)
-        bytes_ = np.asarray(bytes_, dtype='uint8')
-        block_data_tag.payload = bytes_
+        block_data_tag.payload = np.concatenate([np.zeros(0, np.uint8)] + [
+            encode_varints(
+                np.asarray(data[:, y:y + 16, :]).transpose((1, 2, 0)))
+            for y in range(0, self.shape[1], 16)
+        ])
         root_tag.payload = [
             palette_tag,
             palette_max_tag,
@@ -165,7 +459,8 @@ class Schematic(Tilemap):
             version_tag,
             data_version_tag,
         ]
-        nbt.save(root_tag, file)
+        nbt.save(root_tag, file, compresslevel=compresslevel,
+                 workers=workers)
 
 
 
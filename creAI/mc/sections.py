@@ -0,0 +1,356 @@
+"""Sectioned array module.
+
+This module implements a sparse storage for the data of tilemaps. Like the
+chunk sections of Minecraft worlds, the array is split into sections of
+16x16x16 elements, uniform sections are stored as a single value, and the
+rest have their own palette of values with compact indices.
+"""
+
+import itertools
+import numpy as np
+
+# Edge length of the sections
+section_size = 16
+
+
+class SectionedArray(object):
+    """Three-dimensional integer array stored in sections.
+
+    A section is either unallocated (every element is the fill value), a
+    single value, or a palette of values and an array of indices into it in
+    the smallest unsigned integer type. Section arrays are never modified in
+    place, writing a section replaces it, so copies share the sections.
+
+    Basic indexing (integers and slices with a step of 1) works section by
+    section, slicing returns a new SectionedArray. Any other indexing, and
+    numpy functions called on the array, work on a dense copy.
+
+    Args:
+        shape (tuple of int): Shape of the array.
+        dtype (np.dtype): Type of the elements.
+        fill (int): Value of the unallocated sections.
+
+    Attributes:
+        shape (tuple of int): Shape of the array.
+        dtype (np.dtype): Type of the elements.
+        fill (int): Value of the unallocated sections.
+        sections (dict): The allocated sections by their grid positions.
+    """
+    ndim = 3
+
+    def __init__(self, shape: tuple, dtype=np.uint8, fill: int = 0):
+        self.shape = tuple(int(n) for n in shape)
+        if len(self.shape) != 3:
+            raise ValueError(
+                "SectionedArray should be of rank 3, but got shape {}!".format(
+                    self.shape))
+        self.dtype = np.dtype(dtype)
+        self.fill = self.dtype.type(fill)
+        self.sections = {}
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, fill: int = 0):
+        """Splits a dense array into sections."""
+        array = np.asarray(array)
+        self = cls(array.shape, array.dtype, fill)
+        for idx in itertools.product(*map(range, self.grid)):
+            lo, hi = self._bounds(idx)
+            self._store(idx, array[_slices(lo, hi)])
+        return self
+
+    @property
+    def grid(self):
+        """tuple of int: Number of sections along each axis."""
+        return tuple(-(-n // section_size) for n in self.shape)
+
+    @property
+    def size(self):
+        """int: Number of elements."""
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        """int: Memory used by the allocated sections in bytes."""
+        return sum(value[0].nbytes + value[1].nbytes
+                   if isinstance(value, tuple) else value.nbytes
+                   for value in self.sections.values())
+
+    def _bounds(self, idx):
+        lo = np.array(idx) * section_size
+        return lo, np.minimum(lo + section_size, self.shape)
+
+    def _intersecting(self, lo, hi):
+        """Grid positions of the sections intersecting a box."""
+        if (hi <= lo).any():
+            return []
+        return itertools.product(*(
+            range(l // section_size, -(-h // section_size))
+            for l, h in zip(lo, hi)))
+
+    def _store(self, idx, dense):
+        """Replaces a section with the values of a dense array."""
+        first = dense.flat[0]
+        if (dense == first).all():
+            self._store_value(idx, first)
+        else:
+            palette, indices = np.unique(dense, return_inverse=True)
+            self.sections[idx] = (
+                palette.astype(self.dtype),
+                indices.reshape(dense.shape).astype(
+                    np.min_scalar_type(palette.size - 1))
+            )
+
+    def _store_value(self, idx, value):
+        """Replaces a section with a single value."""
+        value = self.dtype.type(value)
+        if value == self.fill:
+            self.sections.pop(idx, None)
+        else:
+            self.sections[idx] = value
+
+    def _load(self, idx):
+        """Returns a section as a new dense array."""
+        lo, hi = self._bounds(idx)
+        value = self.sections.get(idx, self.fill)
+        if isinstance(value, tuple):
+            return value[0][value[1]]
+        return np.full(hi - lo, value, dtype=self.dtype)
+
+    def read(self, lo, hi) -> np.ndarray:
+        """Returns a box of the array as a dense array.
+
+        Args:
+            lo (tuple of int): First corner of the box.
+            hi (tuple of int): Opposite corner of the box, exclusive.
+
+        Returns:
+            np.ndarray: The elements of the box.
+        """
+        lo = np.asarray(lo)
+        hi = np.asarray(hi)
+        out = np.empty(hi - lo, dtype=self.dtype)
+        for idx in self._intersecting(lo, hi):
+            s_lo, s_hi = self._bounds(idx)
+            a = np.maximum(lo, s_lo)
+            b = np.minimum(hi, s_hi)
+            value = self.sections.get(idx, self.fill)
+            if isinstance(value, tuple):
+                palette, indices = value
+                out[_slices(a - lo, b - lo)] = \
+                    palette[indices[_slices(a - s_lo, b - s_lo)]]
+            else:
+                out[_slices(a - lo, b - lo)] = value
+        return out
+
+    def write(self, lo, hi, value):
+        """Assigns a value, an array or a SectionedArray to a box.
+
+        Sections covered by a single value are not allocated, partially
+        covered sections are rebuilt one by one.
+
+        Args:
+            lo (tuple of int): First corner of the box.
+            hi (tuple of int): Opposite corner of the box, exclusive.
+            value: Scalar, array broadcastable to the box, or a
+                SectionedArray of the box's shape.
+        """
+        lo = np.asarray(lo)
+        hi = np.asarray(hi)
+        scalar = not isinstance(value, SectionedArray) and np.ndim(value) == 0
+        if scalar:
+            value = self.dtype.type(value)
+        elif not isinstance(value, SectionedArray):
+            value = np.broadcast_to(value, tuple(hi - lo))
+        for idx in self._intersecting(lo, hi):
+            s_lo, s_hi = self._bounds(idx)
+            a = np.maximum(lo, s_lo)
+            b = np.minimum(hi, s_hi)
+            if scalar:
+                part = value
+            elif isinstance(value, SectionedArray):
+                part = value.read(a - lo, b - lo)
+            else:
+                part = value[_slices(a - lo, b - lo)]
+            if (a == s_lo).all() and (b == s_hi).all():
+                # The whole section is overwritten
+                if scalar:
+                    self._store_value(idx, part)
+                else:
+                    self._store(idx, part)
+                continue
+            current = self.sections.get(idx, self.fill)
+            if scalar and not isinstance(current, tuple) and current == part:
+                continue
+            dense = self._load(idx)
+            dense[_slices(a - s_lo, b - s_lo)] = part
+            self._store(idx, dense)
+
+    def _box(self, key):
+        """Converts basic indices to a box.
+
+        Returns:
+            tuple: First and opposite corner of the box and the axes indexed
+            by integers, or None if the key is not a basic index.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3:
+            return None
+        key = key + (slice(None),) * (3 - len(key))
+        lo, hi, int_axes = [], [], []
+        for axis, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, (int, np.integer)):
+                k = int(k) + n if k < 0 else int(k)
+                if not 0 <= k < n:
+                    raise IndexError(
+                        "Index {} is out of bounds for axis {} with size "
+                        "{}".format(key[axis], axis, n))
+                lo.append(k)
+                hi.append(k + 1)
+                int_axes.append(axis)
+            elif isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step != 1:
+                    return None
+                lo.append(start)
+                hi.append(max(start, stop))
+            else:
+                return None
+        return np.array(lo), np.array(hi), tuple(int_axes)
+
+    def __getitem__(self, key):
+        box = self._box(key)
+        if box is None:
+            return np.asarray(self)[key]
+        lo, hi, int_axes = box
+        if int_axes:
+            return self.read(lo, hi).squeeze(axis=int_axes)[()]
+        return self.crop(lo, hi)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, np.ndarray) and key.dtype == bool \
+                and key.shape == self.shape and np.ndim(value) == 0:
+            self.write_mask(key, value)
+            return
+        box = self._box(key)
+        if box is None:
+            dense = np.asarray(self)
+            dense[key] = value
+            self.sections = SectionedArray.from_array(
+                dense, self.fill).sections
+            return
+        lo, hi, int_axes = box
+        if int_axes and np.ndim(value):
+            value = np.expand_dims(value, int_axes)
+        self.write(lo, hi, value)
+
+    def write_mask(self, mask: np.ndarray, value):
+        """Assigns a value where a boolean mask of the array's shape is
+        true, section by section."""
+        for idx in itertools.product(*map(range, self.grid)):
+            lo, hi = self._bounds(idx)
+            section_mask = mask[_slices(lo, hi)]
+            if not section_mask.any():
+                continue
+            if section_mask.all():
+                self._store_value(idx, value)
+                continue
+            dense = self._load(idx)
+            dense[section_mask] = value
+            self._store(idx, dense)
+
+    def crop(self, lo, hi):
+        """Returns a box of the array as a new SectionedArray.
+
+        Boxes starting at a section boundary share the sections they fully
+        cover, the rest of the sections are rebuilt one by one.
+        """
+        lo = np.asarray(lo)
+        hi = np.asarray(hi)
+        cropped = SectionedArray(hi - lo, self.dtype, self.fill)
+        aligned = not (lo % section_size).any()
+        offset = tuple(lo // section_size)
+        for idx in itertools.product(*map(range, cropped.grid)):
+            c_lo, c_hi = cropped._bounds(idx)
+            src = tuple(i + o for i, o in zip(idx, offset))
+            if aligned and src in self.sections and \
+                    ((c_hi - c_lo) == self._bounds(src)[1] - lo - c_lo).all():
+                cropped.sections[idx] = self.sections[src]
+                continue
+            values = [self.sections.get(s, self.fill)
+                      for s in self._intersecting(c_lo + lo, c_hi + lo)]
+            if not any(isinstance(v, tuple) for v in values) and \
+                    all(v == values[0] for v in values):
+                cropped._store_value(idx, values[0])
+            else:
+                cropped._store(idx, self.read(c_lo + lo, c_hi + lo))
+        return cropped
+
+    def copy(self):
+        """Returns a copy sharing the sections, which are never modified."""
+        copied = SectionedArray(self.shape, self.dtype, self.fill)
+        copied.sections = dict(self.sections)
+        return copied
+
+    def astype(self, dtype, copy=True):
+        """Returns the array with its values converted to a type."""
+        dtype = np.dtype(dtype)
+        if dtype == self.dtype and not copy:
+            return self
+        converted = SectionedArray(self.shape, dtype, self.fill)
+        for idx, value in self.sections.items():
+            if isinstance(value, tuple):
+                converted.sections[idx] = (value[0].astype(dtype), value[1])
+            else:
+                converted.sections[idx] = dtype.type(value)
+        return converted
+
+    def lookup(self, table: np.ndarray):
+        """Maps the values through a lookup table, like table[array].
+
+        Only the palettes of the sections are mapped, so it takes time
+        proportional to the number of sections, not elements.
+        """
+        table = np.asarray(table)
+        mapped = SectionedArray(self.shape, table.dtype, table[self.fill])
+        for idx, value in self.sections.items():
+            if isinstance(value, tuple):
+                mapped.sections[idx] = (table[value[0]], value[1])
+            else:
+                mapped.sections[idx] = table[value]
+        return mapped
+
+    def bincount(self, minlength: int = 0) -> np.ndarray:
+        """Counts the occurrences of the values, like np.bincount."""
+        values = [np.atleast_1d(v[0] if isinstance(v, tuple) else v)
+                  for v in self.sections.values()]
+        values = np.concatenate([np.atleast_1d(self.fill)] + values)
+        if values.min() < 0:
+            raise ValueError("The array contains negative values!")
+        counts = np.zeros(max(minlength, int(values.max()) + 1), dtype=int)
+        covered = 0
+        for idx, value in self.sections.items():
+            lo, hi = self._bounds(idx)
+            count = int(np.prod(hi - lo))
+            covered += count
+            if isinstance(value, tuple):
+                palette, indices = value
+                np.add.at(counts, palette,
+                          np.bincount(indices.ravel(), minlength=palette.size))
+            else:
+                counts[value] += count
+        counts[self.fill] += self.size - covered
+        return counts
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.read((0, 0, 0), self.shape)
+        return dense if dtype is None else dense.astype(dtype)
+
+    def __repr__(self):
+        return 'SectionedArray(shape={}, dtype={}, {} of {} sections ' \
+               'allocated)'.format(self.shape, self.dtype, len(self.sections),
+                                   int(np.prod(self.grid)))
+
+
+def _slices(lo, hi):
+    return tuple(slice(a, b) for a, b in zip(lo, hi))
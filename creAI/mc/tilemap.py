@@ -1,11 +1,17 @@
 """Minecraft Tilemap module.
 """
 
+import contextlib
+import json
+import os
+import tempfile
+import weakref
 import numpy as np
 import warnings
 from typing import List
 
 from creAI.mc.tile import Tile, vectorize
+from creAI.mc.sections import SectionedArray
 
 from creAI.mc.exceptions import *
 
@@ -23,6 +29,36 @@ def to_slice(key, ndim=3):
     return tuple(new_key)
 
 
+def index_dtype(palette_size: int) -> np.dtype:
+    """Returns the smallest unsigned integer type that indexes a palette."""
+    return np.min_scalar_type(max(palette_size - 1, 0))
+
+
+# Names of the tiles counted as air in the statistics
+air_tiles = ('air', 'cave_air', 'void_air')
+
+
+def palette_path(pth: str) -> str:
+    """Returns the path of the palette file of a tilemap saved as .npy."""
+    return os.path.splitext(pth)[0] + '.json'
+
+
+def _as_tile(tile):
+    return tile if isinstance(tile, Tile) else Tile(tile)
+
+
+def _bincount(data, minlength):
+    if isinstance(data, SectionedArray):
+        return data.bincount(minlength=minlength)
+    return np.bincount(data.ravel(), minlength=minlength)
+
+
+def _lookup(table, data):
+    if isinstance(data, SectionedArray):
+        return data.lookup(table)
+    return table[data]
+
+
 class Tilemap(object):
     """Minecraft Tilemap.
 
@@ -34,39 +70,74 @@ class Tilemap(object):
     the palette, and the palette contains only items that are indexed at least 
     once in the data.
 
+    Enforcing this is deferred: edits only mark the tilemap dirty, and
+    unused tiles are dropped when the palette or the data is accessed, or
+    when compact is called. Edits in a batch don't compact the tilemap
+    until the batch ends.
+
+    The data is stored in the smallest unsigned integer type that fits the
+    palette (see index_dtype), it is promoted when the palette grows and
+    converted when the tilemap is compacted.
+
+    Sparse tilemaps store their data in a SectionedArray instead of a dense
+    array: uniform 16x16x16 sections (like air) are not allocated and the
+    rest have their own compact palette, so their memory usage scales with
+    the content instead of the volume. Indexing, slicing and assignments
+    work the same way on them.
+
+    The data given to the tilemap is borrowed, it is copied before the
+    tilemap is modified in place for the first time.
+
+    The number of blocks of each tile is cached once counted (see counts),
+    and kept up to date by the edits of the tilemap. Modifying the data
+    array in place bypasses the cache.
+
     Args:
         shape (tuple of int): Size of the tilemap.
         version (str): Name of the Minecraft version.
-        data (np.ndarray): 3D array of indices.
+        data (np.ndarray): 3D array of indices, it is not copied.
         palette (list of Tile): List of tiles.
+        sparse (bool): Store the data in sections.
 
     Attributes:
         shape (tuple of int): Size of the tilemap.
         version (str): Name of the Minecraft version.
-        data (np.ndarray): 3D array of indices.
+        data (np.ndarray or SectionedArray): 3D array of indices.
         palette (list of Tile): List of tiles.
+        sparse (bool): Whether the data is stored in sections.
 
     """
     def __init__(self, shape: tuple = None, version: str = None, 
-                 data: np.ndarray = None, palette: List[Tile] = None):
+                 data: np.ndarray = None, palette: List[Tile] = None,
+                 sparse: bool = False):
         #Creating tilemap from data and palette
         if data is not None and palette is not None and shape is None:
             self.data = data
             self.palette = palette
-            self.__remap()
+            self._dirty = True
+            if sparse:
+                self.sparse = True
         #Creating tilemap filled with air of a given shape.
         elif data is None and palette is None and shape is not None:
-            self.data = np.zeros(shape, dtype=int)
+            if sparse:
+                self.data = SectionedArray(shape, dtype=index_dtype(1))
+            else:
+                self.data = np.zeros(shape, dtype=index_dtype(1))
+            self._borrowed = False
             self.palette = [Tile('minecraft:air')]
+            self._dirty = False
         else:
             raise TilemapInvalidInitArguments(shape, data, palette)
 
+        self._batch_depth = 0
+        self._views = None
         self.version = version
 
 
     @property
     def palette(self):
         """list of Tile: A list of tiles in the tilemap."""
+        self.__compact_if_dirty()
         return self._p
 
     @palette.setter
@@ -77,7 +148,22 @@ class Tilemap(object):
             for t in val:
                 if not isinstance(t, Tile):
                     raise TilemapPaletteIsNotAListOfTiles(val)
-        self._p = val
+        # The palette is modified in place, the caller's list is copied
+        self._p = list(val)
+        self._index = None
+        self._counts = None
+
+    def __palette_index(self):
+        """Returns a dict of the palette's tiles and their first indices.
+
+        It is built on first use after the palette is replaced, and kept up
+        to date by the assignments that append to the palette.
+        """
+        if self._index is None:
+            self._index = {}
+            for idx, t in enumerate(self._p):
+                self._index.setdefault(t, idx)
+        return self._index
 
     def palette_to_vecs(self, pad_to: int = None) -> np.ndarray:
         """Vectorizing all tiles from the palette.
@@ -88,24 +174,43 @@ class Tilemap(object):
         Returns:
             np.ndarray: Matrix of vectorized tiles.
         """
+        self.__compact_if_dirty()
         return vectorize(self._p, pad_to=pad_to)
 
 
     @property
     def data(self):
         """np.ndarray: 3D integer array. Mapping between indices and palette ids."""
+        self.__compact_if_dirty()
         return self._bd
 
     @data.setter
     def data(self, val):
-        if isinstance(val, np.ndarray):
+        if isinstance(val, (np.ndarray, SectionedArray)):
             if len(val.shape) == 3:
                 self._bd = val
+                self._borrowed = True
+                self._counts = None
             else:
                 raise TilemapDataShapeError(val)
         else:
             raise TilemapDataTypeError(val)
 
+    @property
+    def sparse(self):
+        """bool: Whether the data is stored in sections, setting it converts
+        the data."""
+        return isinstance(self._bd, SectionedArray)
+
+    @sparse.setter
+    def sparse(self, val):
+        if val and not self.sparse:
+            self._bd = SectionedArray.from_array(self._bd)
+            self._borrowed = False
+        elif not val and self.sparse:
+            self._bd = np.asarray(self._bd)
+            self._borrowed = False
+
     @property
     def shape(self):
         """tuple of int: Shape of the tilemap."""
@@ -122,64 +227,478 @@ class Tilemap(object):
         for t in self._p:
             t.version = self._mc_vers
 
+    def compact(self):
+        """Drops the unused tiles of the palette and remaps the data.
+
+        It is called automatically when the palette or the data is
+        accessed after an edit, and at the end of a batch.
+        """
+        self.__remap()
+        self._dirty = False
+
+    def __compact_if_dirty(self):
+        if self._dirty and not self._batch_depth:
+            self.compact()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager for bulk edits.
+
+        The tilemap is not compacted in the batch, not even when its palette
+        or data is accessed, which may contain unused tiles meanwhile. It
+        is compacted once when the outermost batch ends.
+
+        Example:
+            with tlmp.batch():
+                for x in range(16):
+                    tlmp[x, 0, 0] = Tile('minecraft:stone')
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            self.__compact_if_dirty()
+
     def __remap(self):
         """Re-enforcing surjectivity after a change in the tilemap.
+
+        The used indices are counted with np.bincount when the palette is
+        small enough for a lookup table (up to 65536 tiles or the number of
+        voxels), otherwise they are found with np.unique.
+        Unused palette entries are dropped, and the data is rewritten
+        through the lookup table only if any index changes.
         """
         bd = self._bd
         p = self._p
-        u_ids = list(set(bd.flat))  # Unique indices in BlockData
-        p = [p[idx] for idx in u_ids]  # New Palette
-        # Mapping between the original indices and the new indices
-        map_ = dict(zip(u_ids, range(len(u_ids))))
-        bd = np.vectorize(lambda t: map_[t], otypes=[int])(bd)  # Remapping
+        try:
+            if len(p) > max(bd.size, 1 << 16):
+                raise ValueError("Palette is too big for a lookup table")
+            # Raises ValueError for negative indices
+            used = _bincount(bd, minlength=len(p)) > 0
+        except ValueError:
+            u_ids, bd = np.unique(bd, return_inverse=True)
+            bd = bd.reshape(self._bd.shape).astype(index_dtype(u_ids.size))
+            if self.sparse:
+                bd = SectionedArray.from_array(bd)
+        else:
+            u_ids = np.flatnonzero(used)
+            if u_ids.size == len(p) == used.size:
+                self._bd = bd.astype(index_dtype(len(p)), copy=False)
+                self._borrowed = self._borrowed and self._bd is bd
+                return
+            # Mapping between the original indices and the new indices
+            map_ = np.cumsum(used) - 1
+            bd = _lookup(map_.astype(index_dtype(u_ids.size)), bd)
+        if self._counts is not None:
+            self._counts = self.__counts()[u_ids]
         self._bd = bd
-        self._p = p
+        self._borrowed = False
+        self._p = [p[idx] for idx in u_ids]  # New Palette
+        self._index = None
+
+    def __add_tile(self, tile):
+        """Returns the index of a tile, appending it to the palette if new."""
+        index = self.__palette_index()
+        idx = index.get(tile)
+        if idx is None:
+            if isinstance(self._bd, np.memmap):
+                # The saved palette of the file doesn't have the new tile
+                self._bd = np.array(self._bd)
+            idx = index[tile] = len(self._p)
+            self._p.append(tile)
+            if idx > np.iinfo(self._bd.dtype).max:
+                self._bd = self._bd.astype(index_dtype(len(self._p)))
+        return idx
+
+    def __counts(self):
+        """Returns the number of blocks of each palette index.
+
+        The blocks are counted with np.bincount on first use, the counts
+        are padded when tiles are appended to the palette.
+        """
+        if self._counts is None:
+            self._counts = _bincount(self._bd, minlength=len(self._p))
+        elif self._counts.size < len(self._p):
+            self._counts = np.pad(self._counts,
+                                  (0, len(self._p) - self._counts.size))
+        return self._counts
+
+    def __region_counts(self, key):
+        """Counts the indices of a region of the data."""
+        region = self._bd[key]
+        if np.ndim(region) == 0:
+            region = np.array([region])
+        return _bincount(region, minlength=self.__counts().size)
+
+    def counts(self) -> dict:
+        """Returns the number of blocks of each tile.
+
+        The blocks are counted once and the counts are cached, assignments
+        to a region update them by counting only the region.
+
+        Returns:
+            dict: Tiles and their number of blocks, unused tiles are left
+            out.
+        """
+        counts = {}
+        for t, n in zip(self._p, self.__counts()):
+            if n:
+                counts[t] = counts.get(t, 0) + int(n)
+        return counts
+
+    def stats(self) -> dict:
+        """Returns statistics of the blocks of the tilemap.
+
+        It is computed from the cached counts (see counts).
+
+        Returns:
+            dict: The number of blocks ('blocks'), air blocks ('air') and
+            tiles used ('tiles'), and the ratio of air blocks
+            ('air_ratio').
+        """
+        counts = self.counts()
+        blocks = int(np.prod(self.shape))
+        air = sum(n for t, n in counts.items() if t.name in air_tiles)
+        return {
+            'blocks': blocks,
+            'air': air,
+            'air_ratio': air / blocks if blocks else 0.,
+            'tiles': len(counts),
+        }
 
     def __getitem__(self, key):
         key = to_slice(key)
 
+        bd = self._bd[key]
         #if its a single index then return Tile
-        if self._bd[key].shape == ():
-            return self._p[self._bd[key]]
+        if bd.shape == ():
+            return self._p[bd]
         
-        # The slicing operation returns a new Tilemap
-        tlmp = Tilemap(self._bd[key].shape, self._mc_vers)
-        tlmp._bd = self._bd[key]
-        tlmp._p = self._p
-        tlmp.__remap()
-        return tlmp
+        # The slicing operation returns a view of the tilemap
+        return TilemapView(self, key)
+
+    def _before_write(self):
+        """Copies borrowed data and gives the views of the tilemap their own
+        copy of the data, it is called before the data is modified in
+        place."""
+        if self._borrowed:
+            self._bd = self._bd.copy()
+            self._borrowed = False
+        if self._views:
+            for view in list(self._views.values()):
+                view._own()
 
     def __setitem__(self, key, val):
         key = to_slice(key)
+        self._before_write()
+        if not all(isinstance(k, (int, np.integer, slice)) for k in key):
+            # Index arrays may select a block more than once, the counts of
+            # the region would be wrong
+            self._counts = None
 
         if isinstance(val, Tile):
             val.version = self._mc_vers
-            if val not in self._p:
-                self._p.append(val)
-            self._bd[key] = self._p.index(val)
-            self.__remap()
+            val = self.__add_tile(val)
 
         elif isinstance(val, Tilemap):
             val.version = self._mc_vers
-            a = self
-            b = val
-            merged_p = a._p + [t for t in b._p if t not in a._p]
-            map_ = [merged_p.index(t) for t in b._p]
-            a._bd[key] = np.vectorize(
-                lambda t: map_[t],
-                otypes=[int])(b._bd)  # Mapping b's indices to the merged palette
-            a._p = merged_p
-            a.__remap()
+            # Mapping b's indices to the merged palette
+            map_ = [self.__add_tile(t) for t in val._p]
+            map_ = np.array(map_, dtype=self._bd.dtype)
+            val = _lookup(map_, val._bd)
 
         else:
             raise TilemapAssertionTypeError(val)
 
+        # The counts are only updated if the assignment succeeds
+        old_counts = None if self._counts is None \
+            else self.__region_counts(key)
+        self._bd[key] = val
+        self._dirty = True
+        if old_counts is not None:
+            self._counts = self.__counts() - old_counts \
+                + self.__region_counts(key)
+
+
+    def replace(self, mapping: dict):
+        """Replaces tiles with other tiles.
+
+        Only the palette is rewritten, the data is remapped through a
+        lookup table if tiles are merged by the replacement.
+
+        Args:
+            mapping (dict): Tiles (or namespace ids) and their replacements.
+        """
+        mapping = {_as_tile(k): _as_tile(v) for k, v in mapping.items()}
+        palette = []
+        index = {}
+        map_ = np.empty(len(self._p), dtype=self._bd.dtype)
+        for idx, t in enumerate(self._p):
+            if t in mapping:
+                t = mapping[t]
+                t.version = self._mc_vers
+            map_[idx] = index.setdefault(t, len(palette))
+            if map_[idx] == len(palette):
+                palette.append(t)
+        if len(palette) < len(self._p):
+            # Data of views is not modified, it is replaced
+            self._bd = _lookup(map_, self._bd)
+            self._borrowed = False
+            self._dirty = True
+            if self._counts is not None:
+                counts = np.zeros(len(palette), dtype=int)
+                np.add.at(counts, map_, self.__counts())
+                self._counts = counts
+        self._p = palette
+        self._index = index
+
+    def fill(self, mask: np.ndarray, tile: Tile):
+        """Sets a tile where a mask is true.
+
+        Args:
+            mask (np.ndarray): Boolean array of the tilemap's shape.
+            tile (Tile): The tile (or namespace id).
+        """
+        tile = _as_tile(tile)
+        tile.version = self._mc_vers
+        self._before_write()
+        mask = np.asarray(mask, dtype=bool)
+        idx = self.__add_tile(tile)
+        old_counts = None
+        if self._counts is not None and not self.sparse:
+            old_counts = np.bincount(self._bd[mask],
+                                     minlength=self.__counts().size)
+        else:
+            # Sparse data would be made dense to count the masked blocks
+            self._counts = None
+        self._bd[mask] = idx
+        self._dirty = True
+        if old_counts is not None:
+            self._counts = self.__counts() - old_counts
+            self._counts[idx] += np.count_nonzero(mask)
+
+    @classmethod
+    def where(cls, cond: np.ndarray, a, b, version: str = None):
+        """Creates a tilemap from the tiles of a where a condition is true,
+        and of b elsewhere.
+
+        Args:
+            cond (np.ndarray): Boolean array.
+            a (Tilemap or Tile): Tiles where cond is true.
+            b (Tilemap or Tile): Tiles where cond is false.
+            version (str): Minecraft version of the tilemap, by default the
+                version of a or b. It is required if neither of them is a
+                tilemap or a tile with a version.
+
+        Returns:
+            Tilemap: Tilemap of the shape of cond.
+        """
+        # Indices of the tiles of a and b in the merged palette
+        index = {}
+        data = []
+        versions = []
+        for val in (a, b):
+            if isinstance(val, Tilemap):
+                map_ = [index.setdefault(t, len(index)) for t in val._p]
+                data.append(_lookup(
+                    np.array(map_, dtype=index_dtype(len(index))), val._bd))
+                versions.append(val._mc_vers)
+            else:
+                val = _as_tile(val)
+                data.append(index.setdefault(val, len(index)))
+                if val.version is not None:
+                    versions.append(val.version)
+        if version is None:
+            if not versions:
+                raise ValueError(
+                    "The version of the tilemap should be given, when a and "
+                    "b are tiles without a version!")
+            version = versions[0]
+        palette = sorted(index, key=index.get)
+        data = np.where(cond, *data).astype(index_dtype(len(palette)))
+        return cls(data=data, palette=palette, version=version)
+
+    def save_npy(self, pth: str):
+        """Saves the tilemap as a .npy file of its data and a JSON file of
+        its palette (see palette_path).
+
+        The data is saved in its compact type, it is written 16 layers at
+        a time, so sparse data is never made dense as a whole. Both files
+        are written to temporary files first and moved over the old ones,
+        so a tilemap opened by open_mmap can be saved to its own path.
+
+        Args:
+            pth (str): Path of the .npy file.
+        """
+        data = self.data
+        palette = self.palette
+        directory = os.path.dirname(os.path.abspath(pth))
+        tmp_pths = []
+        try:
+            fd, tmp_pth = tempfile.mkstemp(suffix='.npy', dir=directory)
+            os.close(fd)
+            tmp_pths.append(tmp_pth)
+            out = np.lib.format.open_memmap(tmp_pth, mode='w+',
+                                            dtype=data.dtype,
+                                            shape=data.shape)
+            for y in range(0, self.shape[1], 16):
+                out[:, y:y + 16, :] = np.asarray(data[:, y:y + 16, :])
+            out.flush()
+            del out
+
+            fd, tmp_pth = tempfile.mkstemp(suffix='.json', dir=directory)
+            tmp_pths.append(tmp_pth)
+            with os.fdopen(fd, 'w') as palette_file:
+                json.dump({'version': self._mc_vers,
+                           'palette': [t.id for t in palette]}, palette_file)
+
+            os.replace(tmp_pths[0], pth)
+            os.replace(tmp_pths[1], palette_path(pth))
+        finally:
+            for tmp_pth in tmp_pths:
+                if os.path.exists(tmp_pth):
+                    os.remove(tmp_pth)
+
+    @classmethod
+    def open_mmap(cls, pth: str, mode: str = 'r'):
+        """Opens a tilemap saved by save_npy without reading its data.
+
+        The data is a memory-mapped array, so only the parts that are used
+        are read through the page cache. Saved tilemaps are compact, they
+        are not compacted on opening. Edits that grow the palette or merge
+        tiles copy the data into memory first, so the file always matches
+        its saved palette; the changes are only saved by save_npy.
+
+        Args:
+            pth (str): Path of the .npy file.
+            mode (str): Memory-map mode, 'r' is read-only, 'r+' writes
+                assignments to the file, 'c' keeps them in memory.
+
+        Returns:
+            Tilemap: The tilemap.
+        """
+        data = np.load(pth, mmap_mode=mode)
+        with open(palette_path(pth)) as palette_file:
+            saved = json.load(palette_file)
+        tlmp = cls(data=data, palette=[Tile(id_) for id_ in saved['palette']],
+                   version=saved['version'])
+        tlmp._dirty = False
+        # Assignments are written to the file
+        tlmp._borrowed = False
+        return tlmp
+
+    def equals(self, other) -> bool:
+        """Checks whether two tilemaps have the same tile at every position.
+
+        The order of their palettes and unused tiles don't matter, so they
+        are compared without compacting them. Tilemaps are compared by
+        identity with ==, so they stay hashable.
+
+        Args:
+            other (Tilemap): The other tilemap.
+
+        Returns:
+            bool: Whether the tilemaps are equal.
+        """
+        if self.shape != other.shape:
+            return False
+        # Numbering the tiles of both palettes together
+        numbers = {}
+        map_a = np.array([numbers.setdefault(t, len(numbers))
+                          for t in self._p], dtype=int)
+        map_b = np.array([numbers.setdefault(t, len(numbers))
+                          for t in other._p], dtype=int)
+        return bool(np.array_equal(_lookup(map_a, self._bd),
+                                   _lookup(map_b, other._bd)))
 
     def __str__(self):
+        self.__compact_if_dirty()
         o_str = ''
         o_str += 'Palette:\n'
         for idx, val in enumerate(self._p):
             o_str += '\t{}: {}\n'.format(idx, val)
         o_str += 'BlockData:\n'
-        o_str += str(self._bd)
+        o_str += str(np.asarray(self._bd))
         return o_str
+
+    def __getstate__(self):
+        # Views are not pickled with the tilemap, pickled views own their
+        # data
+        state = self.__dict__.copy()
+        state['_views'] = None
+        if state.get('_base') is not None:
+            state['_base'] = None
+            state['_bd'] = self._bd.copy()
+            state['_p'] = list(self._p)
+            state['_index'] = None
+            state['_dirty'] = True
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+class TilemapView(Tilemap):
+    """View of a part of a tilemap.
+
+    Slicing a tilemap returns a view that references the data array and the
+    palette of the tilemap instead of copying them, so its palette may
+    contain tiles that are not used in the view. The view gets its own copy
+    of its data and palette (and is compacted like any tilemap afterwards)
+    when it is written to or compacted, or when the tilemap it references
+    is modified in place.
+
+    Args:
+        parent (Tilemap): The sliced tilemap.
+        key (tuple): Slices of the view.
+    """
+    def __init__(self, parent: Tilemap, key: tuple):
+        # Views of views reference the tilemap that owns the data
+        base = parent._base if isinstance(parent, TilemapView) \
+            and parent._base is not None else parent
+        self._bd = parent._bd[key]
+        self._p = parent._p
+        self._index = None
+        self._counts = None
+        self._dirty = False
+        self._borrowed = False
+        self._batch_depth = 0
+        self._views = None
+        self._mc_vers = parent._mc_vers
+        self._base = base
+        # Tilemaps compare by identity, the views are stored by their ids
+        if base._views is None:
+            base._views = weakref.WeakValueDictionary()
+        base._views[id(self)] = self
+
+    @property
+    def palette(self):
+        """list of Tile: A list of tiles in the view, a copy while the view
+        references the palette of the tilemap."""
+        if self._base is not None:
+            return list(self._p)
+        return super(TilemapView, self).palette
+
+    @palette.setter
+    def palette(self, val):
+        Tilemap.palette.fset(self, val)
+
+    def _own(self):
+        """Copies the referenced data and palette."""
+        if self._base is None:
+            return
+        self._base._views.pop(id(self), None)
+        self._base = None
+        self._bd = self._bd.copy()
+        self._p = list(self._p)
+        self._index = None
+        self._dirty = True
+
+    def compact(self):
+        self._own()
+        super(TilemapView, self).compact()
+
+    def _before_write(self):
+        self._own()
+        super(TilemapView, self)._before_write()
@@ -0,0 +1,55 @@
+import unittest
+import csv
+import tempfile
+from os.path import join, dirname, isfile
+
+from creAI.app import process_schematics
+from creAI.exceptions import *
+from creAI.mc import Schematic
+
+test_schems_path = join(dirname(dirname(__file__)), 'test_mc', 'test_schems')
+
+class TestApp(unittest.TestCase):
+
+    def test_validate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            broken_pth = join(tmp_dir, 'broken.schem')
+            with open(broken_pth, 'wb') as broken_file:
+                broken_file.write(b'not a schematic')
+            report_pth = join(tmp_dir, 'report.csv')
+
+            results = process_schematics(tmp_dir, workers=2,
+                                         report=report_pth)
+            self.assertEqual(len(results), 1)
+            self.assertEqual(results[0][0], broken_pth)
+            self.assertIsNotNone(results[0][2])
+
+            with open(report_pth, newline='') as report_file:
+                rows = list(csv.DictReader(report_file))
+            self.assertEqual(rows[0]['file'], broken_pth)
+            self.assertEqual(rows[0]['status'], 'failed')
+
+        with self.assertRaises(SchematicFileMissing):
+            process_schematics('this_dir_does_not_exist')
+
+    def test_convert(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results = process_schematics(test_schems_path, output=tmp_dir,
+                                         mc_version='1.15.2', workers=2)
+            self.assertTrue(results)
+            self.assertTrue(all(r[2] is None for r in results))
+
+            for name in ('lime_walls_16x16x16.schem',
+                         'brick_building_16x16x16.schem'):
+                self.assertTrue(isfile(join(tmp_dir, name)))
+                with open(join(test_schems_path, name), 'rb') as schem_file:
+                    original = Schematic.load(schem_file, '1.15.2')
+                with open(join(tmp_dir, name), 'rb') as schem_file:
+                    converted = Schematic.load(schem_file, '1.15.2')
+                self.assertEqual(original.shape, converted.shape)
+                self.assertEqual(
+                    [original.palette[i].id for i in original.data.flat],
+                    [converted.palette[i].id for i in converted.data.flat])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,367 @@
+"""Benchmarks for the creAI.mc package.
+
+Run this module directly and choose a subcommand, for example:
+
+    python -m creAI.tests.test_mc.benchmark nbt-load --size 1000000
+"""
+import gzip
+import io
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from creAI.cli import CommandlineInterface, command
+from creAI.mc import nbt, Schematic, Tilemap, Tile
+from creAI.mc.schematic import encode_varints
+
+
+def timeit(fun, repeat=3):
+    """Returns the best wall time of a few runs in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def make_schematic_nbt(palette_size, block_count):
+    """Builds a gzip compressed schematic-like NBT file in memory.
+
+    Args:
+        palette_size (int): Number of entries in the Palette compound.
+        block_count (int): Length of the BlockData byte array.
+
+    Returns:
+        bytes: The compressed file contents.
+    """
+    palette = nbt.TAG_Compound(name='Palette')
+    palette.payload = [
+        nbt.TAG_Int(name='minecraft:block_{}[state={}]'.format(i, i % 16),
+                    payload=i)
+        for i in range(palette_size)
+    ]
+    block_data = np.random.randint(0, 128, block_count).astype('uint8')
+    root = nbt.TAG_Compound(name='Schematic')
+    root.payload = [
+        palette,
+        nbt.TAG_Int(name='PaletteMax', payload=palette_size - 1),
+        nbt.TAG_Short(name='Width', payload=16),
+        nbt.TAG_Short(name='Height', payload=16),
+        nbt.TAG_Short(name='Length', payload=16),
+        nbt.TAG_Byte_Array(name='BlockData', payload=block_data),
+        nbt.TAG_Int(name='Version', payload=2),
+        nbt.TAG_Int(name='DataVersion', payload=1976),
+    ]
+    buffer_ = io.BytesIO()
+    nbt.save(root, buffer_)
+    return buffer_.getvalue()
+
+
+def legacy_load(file):
+    """Reference parser that copies the remaining data for every tag.
+
+    This is the parsing strategy ``nbt.load`` used before it switched to a
+    single memoryview, kept here to measure the difference.
+    """
+    def load_string(raw_data, data_offset):
+        data = raw_data[data_offset[0]:]
+        (length,) = struct.unpack_from('>H', data)
+        data_offset[0] += 2 + length
+        return data[2:2 + length].decode('utf-8')
+
+    def load_payload(tag_class, raw_data, data_offset):
+        data = raw_data[data_offset[0]:]
+        if tag_class is nbt.TAG_String:
+            return tag_class(payload=load_string(raw_data, data_offset))
+        if issubclass(tag_class, nbt.TAG_Array):
+            (length,) = struct.unpack_from('>i', data)
+            size = length * tag_class.dtype.itemsize
+            data_offset[0] += size + 4
+            return tag_class(np.frombuffer(data[4:size + 4], tag_class.dtype))
+        if tag_class is nbt.TAG_Compound:
+            tag = tag_class()
+            while True:
+                tag_type = raw_data[data_offset[0]]
+                data_offset[0] += 1
+                if tag_type == nbt.TAG_END:
+                    return tag
+                name = load_string(raw_data, data_offset)
+                child = load_payload(nbt.tag_type_IDs_to_classes[tag_type],
+                                     raw_data, data_offset)
+                child.name = name
+                tag.payload.append(child)
+        if tag_class is nbt.TAG_List:
+            tag = tag_class()
+            tag.element_type = raw_data[data_offset[0]]
+            (size,) = struct.unpack_from('>i', data, 1)
+            data_offset[0] += 5
+            for _ in range(size):
+                tag.payload.append(load_payload(
+                    nbt.tag_type_IDs_to_classes[tag.element_type],
+                    raw_data, data_offset))
+            return tag
+        (payload,) = tag_class.payload_format.unpack_from(data)
+        data_offset[0] += tag_class.payload_format.size
+        return tag_class(payload=payload)
+
+    with gzip.GzipFile(fileobj=file, mode='rb') as g_file:
+        raw_data = g_file.read()
+    data_offset = [1]
+    name = load_string(raw_data, data_offset)
+    root = load_payload(nbt.TAG_Compound, raw_data, data_offset)
+    root.name = name
+    return root
+
+
+def peak_memory(fun):
+    """Returns the size of the result and the peak allocation in bytes."""
+    tracemalloc.start()
+    result = fun()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size, peak
+
+
+def validated_copy(tag):
+    """Rebuilds a tree through the validating constructors."""
+    if isinstance(tag, nbt.TAG_Compound):
+        return nbt.TAG_Compound(
+            name=tag.name, payload=[validated_copy(t) for t in tag.payload])
+    if isinstance(tag, nbt.TAG_List):
+        copy = nbt.TAG_List(name=tag.name)
+        copy.element_type = tag.element_type
+        copy.payload = [validated_copy(t) for t in tag.payload]
+        return copy
+    return type(tag)(name=tag.name, payload=tag.payload)
+
+
+def make_schematic_file(pth, edge, palette_size):
+    """Writes a cube shaped schematic with random blocks.
+
+    Args:
+        pth (str): Path of the schematic file.
+        edge (int): Width, height and length of the schematic.
+        palette_size (int): Number of different tiles.
+    """
+    palette = nbt.TAG_Compound(name='Palette')
+    for i in range(palette_size):
+        palette['minecraft:tile_{}'.format(i)] = nbt.TAG_Int(payload=i)
+    block_data = np.random.randint(0, palette_size, edge**3)
+    root = nbt.TAG_Compound(name='Schematic')
+    root.payload = [
+        palette,
+        nbt.TAG_Int(name='PaletteMax', payload=palette_size - 1),
+        nbt.TAG_Short(name='Width', payload=edge),
+        nbt.TAG_Short(name='Height', payload=edge),
+        nbt.TAG_Short(name='Length', payload=edge),
+        nbt.TAG_Byte_Array(name='BlockData',
+                           payload=encode_varints(block_data)),
+        nbt.TAG_Int(name='Version', payload=2),
+        nbt.TAG_Int(name='DataVersion', payload=1976),
+    ]
+    with open(pth, 'wb') as schem_file:
+        nbt.save(root, schem_file, compresslevel=1)
+
+
+def rss_status(field):
+    """Reads a memory usage field of /proc/self/status in MB (Linux only)."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+
+
+def measure_load(pth, stream):
+    """Loads a schematic, returns the time and the peak RSS increase in MB.
+
+    It should run in a fresh process, the peak RSS is reset before loading.
+    """
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+    before = rss_status('VmRSS')
+    start = time.perf_counter()
+    with open(pth, 'rb') as schem_file:
+        schem = Schematic.load(schem_file, '1.15.2', stream=stream)
+    elapsed = time.perf_counter() - start
+    return elapsed, rss_status('VmHWM') - before, schem.data.nbytes / 2**20
+
+
+def legacy_remap(tlmp):
+    """Reference remap with a set of the indices and np.vectorize.
+
+    This is how Tilemap re-enforced surjectivity before it switched to
+    np.bincount, kept here to measure the difference.
+    """
+    bd = tlmp.data
+    u_ids = list(set(bd.flat))
+    palette = [tlmp.palette[idx] for idx in u_ids]
+    map_ = dict(zip(u_ids, range(len(u_ids))))
+    return np.vectorize(lambda t: map_[t], otypes=[int])(bd), palette
+
+
+class Benchmark(CommandlineInterface):
+    """Benchmarks for the creAI.mc package.
+
+    Each subcommand prints wall times measured on synthetic data.
+    """
+    def __init__(self):
+        super(Benchmark, self).__init__()
+
+    @command
+    def nbt_load(self, size, palette):
+        """NBT loading benchmark.
+
+        Compares nbt.load with the legacy tail-copying parser.
+
+        Args:
+            size (int, optional): Length of the BlockData array.
+            palette (int, optional): Number of palette entries.
+        """
+        size = size or 4000000
+        palette = palette or 4096
+        raw = make_schematic_nbt(palette, size)
+        print('BlockData: {} bytes, Palette: {} entries'.format(size, palette))
+        legacy = timeit(lambda: legacy_load(io.BytesIO(raw)), repeat=1)
+        print('legacy load:\t{:.3f} s'.format(legacy))
+        current = timeit(lambda: nbt.load(io.BytesIO(raw)))
+        print('nbt.load:\t{:.3f} s'.format(current))
+        print('speedup:\t{:.1f}x'.format(legacy / current))
+
+    @command
+    def nbt_save(self, size, palette):
+        """NBT saving benchmark.
+
+        Compares the compression levels of nbt.save.
+
+        Args:
+            size (int, optional): Length of the BlockData array.
+            palette (int, optional): Number of palette entries.
+        """
+        size = size or 4000000
+        palette = palette or 4096
+        root = nbt.load(io.BytesIO(make_schematic_nbt(palette, size)))
+        print('BlockData: {} bytes, Palette: {} entries'.format(size, palette))
+        for compresslevel in (None, 1, 6, 9):
+            buffer_ = io.BytesIO()
+            elapsed = timeit(lambda: nbt.save(
+                root, io.BytesIO(), compresslevel=compresslevel))
+            nbt.save(root, buffer_, compresslevel=compresslevel)
+            print('compresslevel {}:\t{:.3f} s\t{} bytes'.format(
+                compresslevel, elapsed, len(buffer_.getvalue())))
+
+    @command
+    def nbt_tags(self, palette):
+        """NBT tag construction benchmark.
+
+        Compares the trusted tags built by nbt.load with building the same
+        tree through the validating constructors on a palette-heavy file.
+
+        Args:
+            palette (int, optional): Number of palette entries.
+        """
+        palette = palette or 200000
+        raw = make_schematic_nbt(palette, 4096)
+        root = nbt.load(io.BytesIO(raw))
+        print('Palette: {} entries'.format(palette))
+        print('size of a TAG_Int:\t{} bytes'.format(
+            sys.getsizeof(root['PaletteMax'])))
+        elapsed = timeit(lambda: nbt.load(io.BytesIO(raw)))
+        size, peak = peak_memory(lambda: nbt.load(io.BytesIO(raw)))
+        print('nbt.load:\t{:.3f} s\t{:.1f} MB tree\t{:.1f} MB peak'.format(
+            elapsed, size / 1e6, peak / 1e6))
+        elapsed = timeit(lambda: validated_copy(root))
+        print('validated construction (without parsing):\t{:.3f} s'.format(
+            elapsed))
+
+    @command
+    def nbt_query(self, size, palette):
+        """NBT query benchmark.
+
+        Compares nbt.query with nbt.load when only the dimensions are needed.
+
+        Args:
+            size (int, optional): Length of the BlockData array.
+            palette (int, optional): Number of palette entries.
+        """
+        size = size or 4000000
+        palette = palette or 4096
+        raw = make_schematic_nbt(palette, size)
+        paths = ['Width', 'Height', 'Length']
+        print('BlockData: {} bytes, Palette: {} entries'.format(size, palette))
+        loaded = timeit(lambda: [nbt.load(io.BytesIO(raw))[p] for p in paths])
+        print('nbt.load:\t{:.3f} s'.format(loaded))
+        queried = timeit(lambda: nbt.query(io.BytesIO(raw), paths))
+        print('nbt.query:\t{:.3f} s'.format(queried))
+
+    @command
+    def schematic_load(self, edge, palette):
+        """Schematic loading benchmark.
+
+        Compares the time and the peak resident memory of Schematic.load
+        with and without streaming. Every load runs in its own process.
+
+        Args:
+            edge (int, optional): Edge length of the cube shaped schematic.
+            palette (int, optional): Number of palette entries.
+        """
+        edge = edge or 128
+        palette = palette or 200
+        pth = 'benchmark_{}.schem'.format(os.getpid())
+        make_schematic_file(pth, edge, palette)
+        print('Schematic: {0}x{0}x{0}, Palette: {1} entries'.format(
+            edge, palette))
+        try:
+            context = multiprocessing.get_context('spawn')
+            for stream in (False, True):
+                with context.Pool(1) as pool:
+                    elapsed, peak, size = pool.apply(
+                        measure_load, (pth, stream))
+                print('stream={}:\t{:.3f} s\t{:.1f} MB peak RSS increase'
+                      '\t{:.1f} MB data'.format(stream, elapsed, peak, size))
+        finally:
+            os.remove(pth)
+
+    @command
+    def tilemap_remap(self, edge, palette):
+        """Tilemap remapping benchmark.
+
+        Compares assigning a single tile to a tilemap and compacting it,
+        which re-enforces surjectivity over the whole tilemap, with the
+        legacy remap alone.
+
+        Args:
+            edge (int, optional): Edge length of the cube shaped tilemap.
+            palette (int, optional): Number of palette entries.
+        """
+        edge = edge or 256
+        palette = palette or 200
+        tlmp = Tilemap(
+            data=np.random.randint(0, palette, (edge,)*3),
+            palette=[Tile('minecraft:tile_{}'.format(i))
+                     for i in range(palette)]
+        )
+        print('Tilemap: {0}x{0}x{0}, Palette: {1} entries'.format(
+            edge, palette))
+        legacy = timeit(lambda: legacy_remap(tlmp), repeat=1)
+        print('legacy remap:\t{:.3f} s'.format(legacy))
+        tiles = [Tile('minecraft:stone'), Tile('minecraft:tile_0')] * 2
+
+        def set_tile():
+            tlmp[0, 0, 0] = tiles.pop()
+            tlmp.compact()
+
+        current = timeit(set_tile, repeat=4)
+        print('tlmp[0, 0, 0] = tile, compacted:\t{:.3f} s'.format(current))
+        print('speedup:\t{:.1f}x'.format(legacy / current))
+
+
+if __name__ == '__main__':
+    Benchmark().run()
@@ -0,0 +1,191 @@
+import unittest
+import io
+import os
+import struct
+import tempfile
+import zlib
+from os.path import join, dirname, getsize
+import numpy as np
+
+from creAI.mc import nbt, Schematic, Tilemap, Tile
+from creAI.mc.anvil import (pack_block_states, unpack_block_states,
+                            block_state_bits, tile_to_block_state,
+                            block_state_to_tile, export_tilemap,
+                            import_tilemap, sector_size, region_path,
+                            RegionReader, RegionWriter, build_chunk)
+
+
+test_schems_path = join(dirname(__file__), 'test_schems')
+
+def pack_block_states_loop(indices, bits, padded=False):
+    """Reference implementation setting the bits one by one."""
+    per_long = 64 // bits if padded else None
+    longs = []
+    for i, idx in enumerate(indices):
+        for b in range(bits):
+            if padded:
+                pos = (i // per_long) * 64 + (i % per_long) * bits + b
+            else:
+                pos = i * bits + b
+            while len(longs) <= pos // 64:
+                longs.append(0)
+            longs[pos // 64] |= ((int(idx) >> b) & 1) << (pos % 64)
+    return np.array(longs, dtype=np.uint64).view(np.int64)
+
+def read_chunk(region, x, z):
+    """Reads a chunk of a region file with the reference layout."""
+    (location,) = struct.unpack_from('>I', region, 4 * (x + 32 * z))
+    offset = (location >> 8) * sector_size
+    length, compression = struct.unpack_from('>IB', region, offset)
+    assert compression == 2
+    data = zlib.decompress(region[offset + 5:offset + 4 + length])
+    return nbt.load(io.BytesIO(data))
+
+
+class TestAnvil(unittest.TestCase):
+
+    def test_pack_block_states(self):
+        indices = np.random.randint(0, 37, 4096)
+        bits = block_state_bits(37)
+        self.assertEqual(bits, 6)
+        self.assertEqual(block_state_bits(2), 4)
+        for padded in (False, True):
+            np.testing.assert_array_equal(
+                pack_block_states(indices, bits, padded),
+                pack_block_states_loop(indices, bits, padded))
+            np.testing.assert_array_equal(
+                unpack_block_states(
+                    pack_block_states(indices, bits, padded), bits,
+                    padded=padded),
+                indices)
+        self.assertEqual(pack_block_states(indices, bits).size, 384)
+        self.assertEqual(pack_block_states(indices, bits, True).size, 410)
+
+    def test_tile_to_block_state(self):
+        block_state = tile_to_block_state(
+            Tile('minecraft:oak_stairs[facing=east,half=top]'))
+        self.assertEqual(block_state['Name'].payload, 'minecraft:oak_stairs')
+        self.assertEqual(block_state['Properties']['facing'].payload, 'east')
+        self.assertEqual(block_state['Properties']['half'].payload, 'top')
+        block_state = tile_to_block_state(Tile('minecraft:stone'))
+        self.assertNotIn('Properties', block_state)
+
+        tile = Tile('minecraft:oak_stairs[facing=east,half=top]')
+        self.assertEqual(block_state_to_tile(tile_to_block_state(tile)).id,
+                         tile.id)
+
+    def test_export_tilemap(self):
+        with open(join(test_schems_path, 'brick_building_16x16x16.schem'),
+                  'rb') as schem_file:
+            schem = Schematic.load(schem_file, '1.15.2')
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # The tilemap spans over 2x2 chunks of 2 regions
+            pths = export_tilemap(schem, tmp_dir, origin=(-8, 60, 8))
+            self.assertEqual([p.split('/')[-1] for p in pths],
+                             ['r.-1.0.mca', 'r.0.0.mca'])
+            for pth in pths:
+                self.assertEqual(getsize(pth) % sector_size, 0)
+
+            with open(pths[1], 'rb') as region_file:
+                region = region_file.read()
+            chunk = read_chunk(region, 0, 0)
+            level = chunk['Level']
+            self.assertEqual(chunk['DataVersion'].payload, 2230)
+            self.assertEqual((level['xPos'].payload, level['zPos'].payload),
+                             (0, 0))
+            self.assertEqual([s['Y'].payload for s in level['Sections']],
+                             [3, 4])
+
+            # Blocks from (0, 64, 8) to (8, 76, 16) are in section 4
+            section = level['Sections'][1]
+            palette = [s['Name'].payload for s in section['Palette']]
+            bits = block_state_bits(len(palette))
+            longs = section['BlockStates'].payload
+            self.assertEqual(longs.size, 4096 * bits // 64)
+            bit_array = np.unpackbits(
+                longs.astype('<i8').view(np.uint8), bitorder='little')
+            indices = (bit_array.reshape((4096, bits)) << np.arange(bits))
+            indices = indices.sum(axis=1).reshape((16, 16, 16))
+            names = np.array(palette)[indices].transpose((2, 0, 1))
+            expected = [[[schem.palette[i].id.split('[')[0] for i in row]
+                         for row in plane]
+                        for plane in schem.data[8:, 4:, :8]]
+            np.testing.assert_array_equal(names[:8, :12, 8:], expected)
+            self.assertTrue((names[:, 12:] == 'minecraft:air').all())
+            self.assertTrue((names[:, :, :8] == 'minecraft:air').all())
+
+        with self.assertRaises(ValueError):
+            export_tilemap(schem, tmp_dir, origin=(0, 250, 0))
+
+    def test_import_tilemap(self):
+        with open(join(test_schems_path, 'brick_building_16x16x16.schem'),
+                  'rb') as schem_file:
+            schem = Schematic.load(schem_file, '1.15.2')
+        ids = np.array([t.id for t in schem.palette])[schem.data]
+
+        for data_version in (2230, 2586):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                export_tilemap(schem, tmp_dir, origin=(-8, 60, 8),
+                               data_version=data_version)
+
+                tlmp = import_tilemap(tmp_dir, (-8, 60, 8), (16, 16, 16),
+                                      version='1.15.2')
+                self.assertEqual(tlmp.shape, (16, 16, 16))
+                self.assertEqual(tlmp.version, '1.15.2')
+                np.testing.assert_array_equal(
+                    np.array([t.id for t in tlmp.palette])[tlmp.data], ids)
+
+                # A box reaching out of the exported chunks and regions
+                tlmp = import_tilemap(tmp_dir, (-20, 50, 4), (32, 20, 60))
+                loaded = np.array([t.id for t in tlmp.palette])[tlmp.data]
+                np.testing.assert_array_equal(
+                    loaded[12:28, 10:20, 4:20], ids[:, :10])
+                self.assertTrue((loaded[:12] == 'minecraft:air').all())
+                self.assertTrue((loaded[:, :, 20:] == 'minecraft:air').all())
+
+    def test_export_into_world(self):
+        terrain = Tilemap(shape=(48, 16, 48))
+        terrain[:, :8, :] = Tile('minecraft:stone')
+        build = Tilemap(shape=(4, 4, 4))
+        build[:, :, :] = Tile('minecraft:glass')
+        build[0, 0, 0] = Tile('minecraft:stone')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            export_tilemap(terrain, tmp_dir, origin=(0, 0, 0))
+            pth = region_path(tmp_dir, 0, 0)
+            with open(pth, 'rb') as region_file:
+                untouched = RegionReader(region_file).read_raw(0, 0)
+
+            # The build is merged into chunk (1, 1) and the existing blocks
+            export_tilemap(build, tmp_dir, origin=(20, 6, 20),
+                           data_version=2586)
+            with open(pth, 'rb') as region_file:
+                reader = RegionReader(region_file)
+                self.assertEqual(reader.read_raw(0, 0), untouched)
+                chunk = reader.read_chunk(1, 1)
+            self.assertEqual(chunk['DataVersion'].payload, 2230)
+            self.assertNotIn('Heightmaps', chunk['Level'])
+
+            tlmp = import_tilemap(tmp_dir, (0, 0, 0), (48, 16, 48))
+            expected = np.full((48, 16, 48), 'minecraft:air', dtype=object)
+            expected[:, :8, :] = 'minecraft:stone'
+            expected[20:24, 6:10, 20:24] = 'minecraft:glass'
+            expected[20, 6, 20] = 'minecraft:stone'
+            np.testing.assert_array_equal(
+                np.array([t.id for t in tlmp.palette], dtype=object)[tlmp.data],
+                expected)
+
+            # Chunks that can't be merged are only replaced on request
+            with open(pth, 'wb') as region_file, \
+                    RegionWriter(region_file) as writer:
+                writer.write_chunk(1, 1, build_chunk(1, 1, [], 2860))
+            with self.assertRaises(ValueError):
+                export_tilemap(build, tmp_dir, origin=(20, 6, 20))
+            export_tilemap(build, tmp_dir, origin=(20, 6, 20),
+                           overwrite=True)
+            tlmp = import_tilemap(tmp_dir, (20, 6, 20), (4, 4, 4))
+            self.assertTrue(tlmp.equals(build))
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['r.0.0.mca'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+import unittest
+import gc
+import gzip
+import io
+import struct
+import threading
+from os.path import join, dirname
+import numpy as np
+
+from creAI.mc import nbt
+from creAI.tests.test_mc.benchmark import legacy_load, validated_copy
+
+
+test_schems_path = join(dirname(__file__), 'test_schems')
+
+def make_tree():
+    """Builds an NBT tree containing every tag type."""
+    nested = nbt.TAG_Compound(name='Nested')
+    nested.payload = [nbt.TAG_String(name='Text', payload='árvíztűrő')]
+    positions = nbt.TAG_List(name='Pos')
+    positions.element_type = nbt.TAG_DOUBLE
+    positions.payload = [nbt.TAG_Double(payload=v) for v in (1.5, -2., 3.)]
+    root = nbt.TAG_Compound(name='Root')
+    root.payload = [
+        nbt.TAG_Byte(name='Byte', payload=7),
+        nbt.TAG_Short(name='Short', payload=-300),
+        nbt.TAG_Int(name='Int', payload=70000),
+        nbt.TAG_Long(name='Long', payload=-2**40),
+        nbt.TAG_Float(name='Float', payload=0.5),
+        nbt.TAG_Double(name='Double', payload=0.25),
+        nbt.TAG_Byte_Array(name='Bytes', payload=np.arange(10)),
+        nbt.TAG_Int_Array(name='Ints', payload=np.arange(5)),
+        nbt.TAG_Long_Array(name='Longs', payload=np.arange(3)),
+        positions,
+        nested,
+    ]
+    return root
+
+def save_to_bytes(root):
+    buffer_ = io.BytesIO()
+    nbt.save(root, buffer_)
+    return buffer_.getvalue()
+
+
+class TestNBT(unittest.TestCase):
+
+    def test_load(self):
+        root = nbt.load(io.BytesIO(save_to_bytes(make_tree())))
+
+        self.assertEqual(root.name, 'Root')
+        self.assertEqual(root['Byte'].payload, 7)
+        self.assertEqual(root['Short'].payload, -300)
+        self.assertEqual(root['Int'].payload, 70000)
+        self.assertEqual(root['Long'].payload, -2**40)
+        self.assertEqual(root['Float'].payload, 0.5)
+        self.assertEqual(root['Double'].payload, 0.25)
+        np.testing.assert_array_equal(root['Bytes'].payload, np.arange(10))
+        np.testing.assert_array_equal(root['Ints'].payload, np.arange(5))
+        np.testing.assert_array_equal(root['Longs'].payload, np.arange(3))
+        self.assertEqual([t.payload for t in root['Pos'].payload],
+                         [1.5, -2., 3.])
+        self.assertEqual(root['Nested']['Text'].payload, 'árvíztűrő')
+
+    def test_lazy_load(self):
+        raw = save_to_bytes(make_tree())
+        eager = nbt.load(io.BytesIO(raw))
+        lazy = nbt.load(io.BytesIO(raw), lazy=True)
+
+        #Payloads are only decoded on access
+        self.assertIsNotNone(lazy._lazy)
+        bytes_tag = lazy['Bytes']
+        self.assertIsNone(lazy._lazy)
+        self.assertIsNotNone(bytes_tag._lazy)
+
+        self.assertEqual(save_to_bytes(lazy)[10:], save_to_bytes(eager)[10:])
+        self.assertEqual(lazy['Nested']['Text'].payload, 'árvíztűrő')
+        self.assertEqual(lazy['Pos'].element_type, nbt.TAG_DOUBLE)
+
+    def test_compound_index(self):
+        root = make_tree()
+        self.assertIn('Int', root)
+        self.assertNotIn('Missing', root)
+        self.assertIsNone(root.get('Missing'))
+        with self.assertRaises(KeyError):
+            root['Missing']
+
+        #Replacing keeps the position, new names are appended
+        root['Int'] = nbt.TAG_Int(payload=1)
+        root['Extra'] = nbt.TAG_String(payload='foo')
+        self.assertEqual(root['Int'].payload, 1)
+        self.assertEqual(list(root.keys())[2], 'Int')
+        self.assertEqual(list(root.keys())[-1], 'Extra')
+        self.assertEqual(len(root.payload), 12)
+
+        root.payload = root.payload[:1]
+        self.assertEqual(list(root.keys()), ['Byte'])
+
+        #Mutating the payload in place and renaming tags
+        root.payload.append(nbt.TAG_Int(name='Appended', payload=2))
+        self.assertEqual(root['Appended'].payload, 2)
+        root['Appended'].name = 'Renamed'
+        self.assertNotIn('Appended', root)
+        self.assertEqual(root['Renamed'].payload, 2)
+        self.assertEqual(list(root.keys()), ['Byte', 'Renamed'])
+        root.payload.pop()
+        self.assertNotIn('Renamed', root)
+
+        #Replacing a tag in place, removing and appending tags
+        root.payload.append(nbt.TAG_Int(name='A', payload=1))
+        root.payload.append(nbt.TAG_Int(name='B', payload=2))
+        root.payload[1] = nbt.TAG_Int(name='A', payload=99)
+        self.assertEqual(root['A'].payload, 99)
+        root.payload.pop()
+        root.payload.append(nbt.TAG_Int(name='C', payload=3))
+        self.assertNotIn('B', root)
+        self.assertEqual(list(root.keys()), ['Byte', 'A', 'C'])
+
+    def test_iterparse(self):
+        raw = save_to_bytes(make_tree())
+        events = list(nbt.iterparse(io.BytesIO(raw), chunk_size=4))
+
+        self.assertEqual(events[0], ('', nbt.TAG_COMPOUND, 'Root', None))
+        self.assertEqual(events[-1], ('', nbt.TAG_END, 'Root', None))
+        self.assertIn(('Int', nbt.TAG_INT, 'Int', 70000), events)
+        self.assertIn(('Nested/Text', nbt.TAG_STRING, 'Text', 'árvíztűrő'),
+                      events)
+        self.assertIn(('Pos', nbt.TAG_LIST, 'Pos', (nbt.TAG_DOUBLE, 3)),
+                      events)
+        self.assertIn(('Pos/1', nbt.TAG_DOUBLE, '1', -2.), events)
+
+        #Arrays are split into chunks of at most 4 bytes
+        chunks = [e[3] for e in events if e[0] == 'Bytes']
+        self.assertEqual([c.size for c in chunks], [4, 4, 2])
+        np.testing.assert_array_equal(np.concatenate(chunks), np.arange(10))
+        chunks = [e[3] for e in events if e[0] == 'Longs']
+        self.assertEqual(len(chunks), 3)
+
+    def test_save(self):
+        tree = make_tree()
+        reference = save_to_bytes(tree)
+        for compresslevel in (None, 0, 1, 9):
+            buffer_ = io.BytesIO()
+            nbt.save(tree, buffer_, compresslevel=compresslevel)
+            raw = buffer_.getvalue()
+            self.assertEqual(raw[:2] == nbt.GZIP_MAGIC,
+                             compresslevel is not None)
+            root = nbt.load(io.BytesIO(raw))
+            self.assertEqual(save_to_bytes(root)[10:], reference[10:])
+
+    def test_failed_save(self):
+        tree = make_tree()
+        tree['Byte'].payload = 1000
+        for compresslevel, workers in ((None, None), (9, None), (9, 2)):
+            buffer_ = io.BytesIO()
+            threads = threading.active_count()
+            with self.assertRaises(struct.error):
+                nbt.save(tree, buffer_, compresslevel, workers)
+            gc.collect()
+            #The file is not closed and no threads are left running
+            self.assertFalse(buffer_.closed)
+            self.assertEqual(threading.active_count(), threads)
+
+    def test_parallel_save(self):
+        tree = make_tree()
+        tree.append(nbt.TAG_Byte_Array(
+            name='Big', payload=np.arange(100000) % 7))
+        raw = io.BytesIO()
+        nbt.save(tree, raw, compresslevel=None)
+
+        block_size = nbt.parallel_block_size
+        nbt.parallel_block_size = 4096
+        try:
+            buffer_ = io.BytesIO()
+            nbt.save(tree, buffer_, workers=4)
+        finally:
+            nbt.parallel_block_size = block_size
+
+        #A single gzip member that decompresses to the same data
+        self.assertEqual(gzip.decompress(buffer_.getvalue()), raw.getvalue())
+        root = nbt.load(io.BytesIO(buffer_.getvalue()))
+        np.testing.assert_array_equal(root['Big'].payload,
+                                      np.arange(100000) % 7)
+
+    def test_numeric_list(self):
+        raw = save_to_bytes(make_tree())
+        for lazy in (False, True):
+            root = nbt.load(io.BytesIO(raw), lazy=lazy)
+            positions = root['Pos']
+            np.testing.assert_array_equal(positions.array, [1.5, -2., 3.])
+            self.assertIsInstance(positions[1], nbt.TAG_Double)
+            self.assertEqual(positions[1].payload, -2.)
+            self.assertEqual(save_to_bytes(root)[10:], raw[10:])
+
+            #Switching to the TAG representation and back
+            self.assertEqual(positions.payload[2].payload, 3.)
+            positions.payload[2].payload = 4.
+            np.testing.assert_array_equal(positions.array, [1.5, -2., 4.])
+
+            #Elements are kept, modifying them through indexing
+            self.assertIs(positions[1], positions[1])
+            positions[1].payload = 99.
+            np.testing.assert_array_equal(positions.array, [1.5, 99., 4.])
+            self.assertEqual(nbt.load(io.BytesIO(save_to_bytes(root)))
+                             ['Pos'][1].payload, 99.)
+
+    def test_query(self):
+        raw = save_to_bytes(make_tree())
+        found = nbt.query(io.BytesIO(raw),
+                          ['Int', 'Nested/*', 'Pos/1', 'Longs', 'Missing'])
+
+        self.assertEqual(list(found.keys()),
+                         ['Int', 'Longs', 'Pos/1', 'Nested/Text'])
+        self.assertEqual(found['Int'].name, 'Int')
+        self.assertEqual(found['Int'].payload, 70000)
+        np.testing.assert_array_equal(found['Longs'].payload, np.arange(3))
+        self.assertEqual(found['Pos/1'].payload, -2.)
+        self.assertEqual(found['Nested/Text'].payload, 'árvíztűrő')
+
+        #Whole subtrees
+        found = nbt.query(io.BytesIO(raw), 'Nested')
+        self.assertEqual(found['Nested']['Text'].payload, 'árvíztűrő')
+
+    def test_load_schematic(self):
+        with open(join(test_schems_path, 'lime_walls_16x16x16.schem'), 'rb') \
+            as schem_file:
+            root = nbt.load(schem_file)
+
+        self.assertEqual(root['Width'].payload, 16)
+        self.assertEqual(root['BlockData'].payload.size, 16*16*16)
+
+    def test_trusted_load(self):
+        #Tags built by the loader match the tags of the validating legacy
+        #parser on the test schematics
+        for schem in ('brick_building_16x16x16.schem',
+                      'lime_walls_16x16x16.schem',
+                      'random_pattern_16x16x16.schem',
+                      'repeating_pattern_16x16x16.schem'):
+            with open(join(test_schems_path, schem), 'rb') as schem_file:
+                raw = schem_file.read()
+            root = nbt.load(io.BytesIO(raw))
+            reference = legacy_load(io.BytesIO(raw))
+            self.assertSameTree(root, reference)
+            self.assertSameTree(validated_copy(root), reference)
+            self.assertEqual(save_to_bytes(root)[10:],
+                             save_to_bytes(reference)[10:])
+
+    def assertSameTree(self, tag, reference):
+        self.assertIs(type(tag), type(reference))
+        self.assertEqual(tag.name, reference.name)
+        #Tags don't have a __dict__
+        self.assertFalse(hasattr(tag, '__dict__'))
+        if isinstance(tag, (nbt.TAG_Compound, nbt.TAG_List)):
+            self.assertEqual(len(tag.payload), len(reference.payload))
+            for child, reference_child in zip(tag.payload, reference.payload):
+                self.assertSameTree(child, reference_child)
+            if isinstance(tag, nbt.TAG_Compound):
+                self.assertEqual(list(tag.keys()), list(reference.keys()))
+            else:
+                self.assertEqual(tag.element_type, reference.element_type)
+        elif isinstance(tag, nbt.TAG_Array):
+            self.assertEqual(tag.payload.dtype, reference.payload.dtype)
+            np.testing.assert_array_equal(tag.payload, reference.payload)
+        else:
+            self.assertEqual(tag.payload, reference.payload)
+
+if __name__ == '__main__':
+    unittest.main()
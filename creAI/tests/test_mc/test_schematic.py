@@ -1,14 +1,34 @@
 import unittest
-from os.path import join, dirname
+import io
+import tempfile
+from os.path import join, dirname, isfile
 import numpy as np
 
 from creAI import App
 from creAI.mc import Tile, Schematic
+from creAI.mc.schematic import decode_varints, encode_varints
 from creAI.mc.exceptions import *
 
 
 test_schems_path = join(dirname(__file__), 'test_schems')
 
+def decode_varints_loop(block_data, count):
+    """Reference varint decoder, one byte at a time."""
+    values = []
+    data_offset = 0
+    for _ in range(count):
+        value = 0
+        length = 0
+        while True:
+            next_byte = int(block_data[data_offset])
+            value |= (next_byte & 127) << length*7
+            length += 1
+            data_offset += 1
+            if next_byte < 128:
+                break
+        values.append(value)
+    return np.array(values)
+
 class TestSchematic(unittest.TestCase):
 
     def test_load(self):
@@ -19,6 +39,104 @@ class TestSchematic(unittest.TestCase):
         self.assertEqual(len(schem.palette), 2)
         self.assertEqual(schem.shape, (16,16,16))
 
+    def test_decode_varints(self):
+        values = np.random.randint(0, 2**31, 1000) \
+            >> np.random.randint(0, 31, 1000)
+        block_data = []
+        for value in values:
+            value = int(value)
+            while value >= 128:
+                block_data.append(value & 127 | 128)
+                value >>= 7
+            block_data.append(value)
+        block_data = np.array(block_data + [5, 6], dtype='uint8')
+
+        np.testing.assert_array_equal(
+            decode_varints(block_data, 1000),
+            decode_varints_loop(block_data, 1000)
+        )
+        np.testing.assert_array_equal(
+            decode_varints(np.arange(10), 8), np.arange(8))
+
+        with self.assertRaises(ValueError):
+            decode_varints(np.array([128, 128, 128, 128, 128, 1]), 1)
+        with self.assertRaises(ValueError):
+            decode_varints(np.array([1, 2, 128]), 3)
+
+    def test_encode_varints(self):
+        values = np.random.randint(0, 2**31, 1000) \
+            >> np.random.randint(0, 31, 1000)
+        block_data = encode_varints(values)
+
+        np.testing.assert_array_equal(decode_varints(block_data, 1000), values)
+        self.assertEqual(block_data.size,
+                         sum(max(1, -(-int(v).bit_length() // 7))
+                             for v in values))
+        np.testing.assert_array_equal(encode_varints([0, 127, 128, 300]),
+                                      [0, 127, 128, 1, 172, 2])
+        for dtype in (np.uint8, np.uint16, np.uint32):
+            np.testing.assert_array_equal(
+                encode_varints(np.array([0, 127, 128, 255], dtype)),
+                [0, 127, 128, 1, 255, 1])
+
+    def test_load_stream(self):
+        import creAI.mc.schematic
+        chunk_size = creAI.mc.schematic.stream_chunk_size
+        #Small chunks split some of the varints
+        creAI.mc.schematic.stream_chunk_size = 7
+        try:
+            for name in ('brick_building_16x16x16.schem',
+                         'random_pattern_16x16x16.schem'):
+                with open(join(test_schems_path, name), 'rb') as schem_file:
+                    schem = Schematic.load(schem_file, '1.15.2')
+                with open(join(test_schems_path, name), 'rb') as schem_file:
+                    streamed = Schematic.load(schem_file, '1.15.2',
+                                              stream=True)
+                self.assertEqual(streamed.palette, schem.palette)
+                np.testing.assert_array_equal(streamed.data, schem.data)
+
+            #Multi-byte ids with the dimensions before BlockData
+            palette = [Tile('minecraft:tile_{}'.format(i)) for i in range(300)]
+            data = np.arange(6*7*8).reshape((6, 7, 8)) % 300
+            buffer_ = io.BytesIO()
+            Schematic(data=data, palette=palette).save(buffer_)
+            buffer_.seek(0)
+            streamed = Schematic.load(buffer_, '1.15.2', stream=True)
+            self.assertEqual(streamed.palette, palette)
+            np.testing.assert_array_equal(streamed.data, data)
+        finally:
+            creAI.mc.schematic.stream_chunk_size = chunk_size
+
+    def test_load_region(self):
+        palette = [Tile('minecraft:tile_{}'.format(i)) for i in range(300)]
+        data = np.random.randint(0, 300, (9, 7, 8))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pth = join(tmp_dir, 'region.schem')
+            with open(pth, 'wb') as schem_file:
+                Schematic(data=data, palette=palette).save(schem_file)
+
+            #The row index is only saved next to the file if asked for
+            with open(pth, 'rb') as schem_file:
+                Schematic.load_region(
+                    schem_file, (2, 1, 3), (5, 4, 3), '1.15.2')
+            self.assertFalse(isfile(pth + '.rows.npy'))
+
+            for _ in range(2):
+                with open(pth, 'rb') as schem_file:
+                    region = Schematic.load_region(
+                        schem_file, (2, 1, 3), (5, 4, 3), '1.15.2',
+                        cache=True)
+                #The second time the index is loaded from the cache
+                self.assertTrue(isfile(pth + '.rows.npy'))
+                tiles = np.array(region.palette, dtype=object)[region.data]
+                expected = np.array(palette, dtype=object)[data[2:7, 1:5, 3:6]]
+                np.testing.assert_array_equal(tiles, expected)
+
+            with open(pth, 'rb') as schem_file:
+                with self.assertRaises(ValueError):
+                    Schematic.load_region(
+                        schem_file, (2, 1, 3), (5, 4, 6), '1.15.2')
+
     def test_save(self):
         #Creating schematic
         schem = Schematic(shape=(5,5,5))
@@ -0,0 +1,86 @@
+import unittest
+import numpy as np
+
+from creAI.mc.sections import SectionedArray
+
+
+def make_array():
+    """Mostly zero array with a few uniform and mixed sections."""
+    array = np.zeros((40, 20, 33), dtype=np.uint16)
+    array[:16, :16, :16] = 3
+    array[20:30, 2:5, 17:32] = np.arange(15)
+    array[39, 19, 32] = 300
+    return array
+
+
+class TestSectionedArray(unittest.TestCase):
+
+    def test_from_array(self):
+        array = make_array()
+        sectioned = SectionedArray.from_array(array)
+        self.assertEqual(sectioned.shape, array.shape)
+        self.assertEqual(sectioned.grid, (3, 2, 3))
+        np.testing.assert_array_equal(np.asarray(sectioned), array)
+
+        #Only the non-zero sections are allocated, one as a single value
+        self.assertEqual(len(sectioned.sections), 3)
+        self.assertEqual(sectioned.sections[0, 0, 0], 3)
+        self.assertLess(sectioned.nbytes, 3 * 16**3)
+
+    def test_indexing(self):
+        array = make_array()
+        sectioned = SectionedArray.from_array(array)
+        self.assertEqual(sectioned[39, 19, 32], 300)
+        self.assertEqual(sectioned[-1, -1, -1], 300)
+        np.testing.assert_array_equal(sectioned[25, :, 17:],
+                                      array[25, :, 17:])
+        np.testing.assert_array_equal(sectioned[::2], array[::2])
+        for key in ((slice(16, 40), slice(None), slice(16, 33)),
+                    (slice(5, 27), slice(1, 19), slice(3, 30))):
+            cropped = sectioned[key]
+            self.assertIsInstance(cropped, SectionedArray)
+            np.testing.assert_array_equal(np.asarray(cropped), array[key])
+
+        #Aligned crops share the sections
+        cropped = sectioned[16:, :, 16:]
+        self.assertIs(cropped.sections[0, 0, 0],
+                      sectioned.sections[1, 0, 1])
+
+    def test_assignment(self):
+        array = make_array()
+        sectioned = SectionedArray.from_array(array)
+        copied = sectioned.copy()
+        for key, value in (((slice(0, 32), slice(None), slice(None)), 0),
+                           ((slice(3, 7), 4, slice(None)), 9),
+                           ((slice(10, 20), slice(2, 4), slice(1, 3)),
+                            np.arange(4).reshape((2, 2))),
+                           ((slice(None), slice(None), [1, 2]), 5)):
+            array[key] = value
+            sectioned[key] = value
+            np.testing.assert_array_equal(np.asarray(sectioned), array)
+        mask = array % 3 == 1
+        array[mask] = 7
+        sectioned[mask] = 7
+        np.testing.assert_array_equal(np.asarray(sectioned), array)
+        sectioned[8:24, 0:16, 16:32] = SectionedArray.from_array(
+            array[:16, :16, :16])
+        array[8:24, 0:16, 16:32] = array[:16, :16, :16].copy()
+        np.testing.assert_array_equal(np.asarray(sectioned), array)
+
+        #The copy is not affected
+        np.testing.assert_array_equal(np.asarray(copied), make_array())
+
+    def test_bincount_lookup(self):
+        array = make_array()
+        sectioned = SectionedArray.from_array(array)
+        np.testing.assert_array_equal(sectioned.bincount(minlength=400),
+                                      np.bincount(array.ravel(), minlength=400))
+        table = (np.arange(301) * 7) % 11
+        np.testing.assert_array_equal(np.asarray(sectioned.lookup(table)),
+                                      table[array])
+        converted = sectioned.astype(np.uint32)
+        self.assertEqual(converted.dtype, np.uint32)
+        np.testing.assert_array_equal(np.asarray(converted), array)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,14 @@
 import unittest
+import io
+import pickle
+import os
+import tempfile
 import numpy as np
 
 
 from creAI import App
-from creAI.mc import Tile, Tilemap
+from creAI.mc import Tile, Tilemap, TilemapView, Schematic
+from creAI.mc.sections import SectionedArray
 from creAI.mc.exceptions import *
 
 
@@ -52,5 +57,332 @@ class TestTilemap(unittest.TestCase):
         t[0,0,0] = Tile('minecraft:air')
         self.assertEqual(len(t.palette), 1)
 
+    def test_remap(self):
+        p = [Tile('minecraft:tile_{}'.format(i)) for i in range(10)]
+        d = np.random.choice([1, 4, 5, 8], size=(8, 8, 8))
+        t = Tilemap(data=d, palette=p)
+        #Unused tiles are dropped, the order of the rest is kept
+        self.assertEqual([tile.name for tile in t.palette],
+                         ['tile_1', 'tile_4', 'tile_5', 'tile_8'])
+        self.assertEqual([t.palette[i] for i in t.data.flat],
+                         [p[i] for i in d.flat])
+
+        #Indices too big for a lookup table
+        d = np.random.choice([0, 70000], size=(4, 4, 4))
+        p = [Tile('minecraft:air')] * 70000 + [Tile('minecraft:stone')]
+        t = Tilemap(data=d, palette=p)
+        self.assertEqual(len(t.palette), 2)
+        np.testing.assert_array_equal(t.data, d // 70000)
+
+        #The palette of the caller is not modified
+        p = [Tile('minecraft:air'), Tile('minecraft:stone')]
+        t = Tilemap(data=np.array([[[0,1]]]), palette=p)
+        t[0,0,0] = Tile('minecraft:dirt')
+        self.assertEqual(p, [Tile('minecraft:air'), Tile('minecraft:stone')])
+        self.assertEqual([tile.name for tile in t.palette], ['stone', 'dirt'])
+
+        #The data of the caller is copied before it is modified
+        d = np.array([[[0,1]]])
+        t = Tilemap(data=d, palette=[Tile('minecraft:air'),
+                                     Tile('minecraft:stone')])
+        t[0,0,0] = Tile('minecraft:dirt')
+        t.fill(np.array([[[False, True]]]), Tile('minecraft:sand'))
+        np.testing.assert_array_equal(d, [[[0,1]]])
+
+    def test_batch(self):
+        t = Tilemap(shape=(4,4,4))
+        with t.batch():
+            for x in range(4):
+                t[x,0,0] = Tile('minecraft:stone')
+                t[x,0,0] = Tile('minecraft:dirt')
+            #Unused tiles are kept until the end of the batch
+            self.assertEqual([tile.name for tile in t.palette],
+                             ['air', 'stone', 'dirt'])
+        self.assertEqual([tile.name for tile in t.palette], ['air', 'dirt'])
+        np.testing.assert_array_equal(t.data[:,0,0], [1,1,1,1])
+
+        #Edits are compacted on access or explicitly
+        t[0,0,0] = Tile('minecraft:stone')
+        t[1:,0,0] = Tile('minecraft:stone')
+        self.assertEqual(len(t._p), 3)
+        t.compact()
+        self.assertEqual(len(t._p), 2)
+
+        #Writing to a slice doesn't change the tilemap
+        s = t[:2,:2,:2]
+        s[0,0,0] = Tile('minecraft:air')
+        self.assertEqual(t[0,0,0].name, 'stone')
+
+    def test_merge(self):
+        tiles = [Tile('minecraft:tile_{}'.format(i)) for i in range(3000)]
+        a = Tilemap(data=np.arange(2000).reshape((20,10,10)),
+                    palette=tiles[:2000])
+        b = Tilemap(data=np.arange(2000).reshape((20,10,10)),
+                    palette=tiles[1000:])
+        a[:, :5] = b[:, 5:]
+        self.assertEqual(len(a.palette), 1500)
+        self.assertEqual([a[x,y,z] for x, y, z in np.ndindex(20,5,10)],
+                         [tiles[1000 + i] for i in b.data[:, 5:].flat])
+        self.assertTrue(a[:, 5:].equals(Tilemap(
+            data=np.arange(2000).reshape((20,10,10))[:, 5:],
+            palette=tiles[:2000])))
+
+        #Assigning tiles already in the palette keeps their index
+        a[0,0,0] = Tile('minecraft:tile_1999')
+        a[0,0,1] = Tile('minecraft:stone')
+        self.assertEqual(a._p[a._bd[0,0,0]], Tile('minecraft:tile_1999'))
+        self.assertEqual(a._bd[0,0,1], 1500)
+
+    def test_dtype(self):
+        t = Tilemap(shape=(4,4,4))
+        self.assertEqual(t.data.dtype, np.uint8)
+        tiles = [Tile('minecraft:tile_{}'.format(i)) for i in range(300)]
+        with t.batch():
+            for i, tile in enumerate(tiles):
+                t[i % 4, i // 4 % 4, i // 16 % 4] = tile
+            #Promoted when the palette outgrows uint8
+            self.assertEqual(t.data.dtype, np.uint16)
+        self.assertEqual(len(t.palette), 64)
+        self.assertEqual(t.data.dtype, np.uint8)
+        self.assertEqual(t[:2, :, :].data.dtype, np.uint8)
+
+        t = Tilemap(data=np.arange(300).reshape((3,10,10)), palette=tiles)
+        self.assertEqual(t.data.dtype, np.uint16)
+        t[:, :1] = Tilemap(shape=(3,1,10))
+        self.assertEqual(t.data.dtype, np.uint16)
+        view = t[:, 2:]
+        self.assertEqual(view.data.dtype, np.uint16)
+        view.compact()
+        self.assertEqual(view.data.dtype, np.uint8)
+
+    def test_sparse(self):
+        dense = Tilemap(shape=(40,60,40))
+        sparse = Schematic(shape=(40,60,40), sparse=True)
+        self.assertIsInstance(sparse.data, SectionedArray)
+        for t in (dense, sparse):
+            t[:, :16, :] = Tile('minecraft:stone')
+            t[3:7, 16:19, 5:30] = Tile('minecraft:oak_planks')
+            t[20:30, 17:20, 17:32] = t[3:13, 15:18, 5:20]
+            t[0,59,0] = Tile('minecraft:glass')
+        self.assertTrue(dense.equals(sparse))
+        self.assertEqual(sparse[0,59,0].name, 'glass')
+        self.assertTrue(
+            sparse[5:30, 1:19, 3:33].equals(dense[5:30, 1:19, 3:33]))
+        self.assertTrue(sparse[5:30, 1:19, 3:33].sparse)
+        #Mostly air, only a few sections are allocated
+        self.assertLess(sparse.data.nbytes, dense.data.nbytes / 4)
+
+        buffers = [io.BytesIO(), io.BytesIO()]
+        Schematic.save(dense, buffers[0])
+        sparse.save(buffers[1])
+        self.assertEqual(buffers[0].getvalue()[10:], buffers[1].getvalue()[10:])
+
+        sparse.sparse = False
+        self.assertIsInstance(sparse.data, np.ndarray)
+        self.assertTrue(dense.equals(sparse))
+
+    def test_view(self):
+        t = Tilemap(shape=(8,8,8))
+        t[:4,:,:] = Tile('minecraft:stone')
+        t[0,0,0] = Tile('minecraft:dirt')
+        view = t[4:,:,:]
+        self.assertIsInstance(view, TilemapView)
+        #The view shares the data and the whole palette
+        self.assertTrue(np.shares_memory(view.data, t.data))
+        self.assertEqual(view.palette, t.palette)
+        #Modifying the palette of the view doesn't change the tilemap
+        view.palette.append(Tile('minecraft:glass'))
+        self.assertEqual(len(t.palette), 3)
+        self.assertEqual(view[0,0,0].name, 'air')
+
+        #Writing to the view copies and compacts it
+        view[0,0,0] = Tile('minecraft:glass')
+        self.assertFalse(np.shares_memory(view.data, t.data))
+        self.assertEqual([tile.name for tile in view.palette], ['air', 'glass'])
+        self.assertEqual(t[4,0,0].name, 'air')
+
+        #Modifying the tilemap copies the views of it and their views
+        view = t[:6,:,:]
+        view_of_view = view[:2,:2,:2]
+        t[:,:,:] = Tile('minecraft:sand')
+        self.assertEqual(view[0,0,0].name, 'dirt')
+        self.assertEqual(view[5,0,0].name, 'air')
+        self.assertEqual(view_of_view[1,0,0].name, 'stone')
+        self.assertEqual(t[0,0,0].name, 'sand')
+
+        #Sliced tilemaps and views can be pickled
+        view = t[:2,:,:]
+        t_copy, view_copy = pickle.loads(pickle.dumps((t, view)))
+        self.assertTrue(t_copy.equals(t))
+        self.assertTrue(view_copy.equals(view))
+        view_copy[0,0,0] = Tile('minecraft:glass')
+        self.assertEqual(t_copy[0,0,0].name, 'sand')
+
+    def test_bulk_edits(self):
+        d = np.arange(64).reshape((4,4,4)) % 4
+        p = [Tile('minecraft:air'), Tile('minecraft:stone'),
+             Tile('minecraft:dirt'), Tile('minecraft:sand')]
+        for sparse in (False, True):
+            t = Tilemap(data=d, palette=list(p), sparse=sparse)
+            view = t[:2,:,:]
+            names = np.array(['air', 'stone', 'dirt', 'sand'])[d]
+
+            #Replacing without merging tiles only changes the palette
+            t.replace({Tile('minecraft:stone'): Tile('minecraft:glass')})
+            self.assertEqual([tile.name for tile in t.palette],
+                             ['air', 'glass', 'dirt', 'sand'])
+            t.replace({'minecraft:dirt': 'minecraft:sand'})
+            self.assertEqual(len(t.palette), 3)
+            names[names == 'stone'] = 'glass'
+            names[names == 'dirt'] = 'sand'
+            self.assertEqual([[[t[x,y,z].name for z in range(4)]
+                               for y in range(4)] for x in range(4)],
+                             names.tolist())
+
+            t.fill(names == 'sand', Tile('minecraft:water'))
+            names[names == 'sand'] = 'water'
+            self.assertTrue(t.equals(Tilemap(
+                data=np.unique(names, return_inverse=True)[1].reshape(d.shape),
+                palette=[Tile('minecraft:' + n) for n in np.unique(names)])))
+            #The view is not affected
+            self.assertEqual(view[0,0,1].name, 'stone')
+
+        cond = d > 1
+        w = Tilemap.where(cond, t, Tile('minecraft:air'))
+        self.assertEqual(w[0,0,2].name, 'water')
+        self.assertEqual(w[0,0,1].name, 'air')
+        w = Tilemap.where(cond, Tilemap(data=d, palette=list(p)), t)
+        self.assertEqual(w[0,0,3].name, 'sand')
+        self.assertEqual(w[0,0,1].name, 'glass')
+        self.assertEqual(len(w.palette), 4)
+
+        #The version is taken from the tilemaps or the tiles, or given
+        t.version = '1.15.2'
+        self.assertEqual(Tilemap.where(cond, Tile('minecraft:air'), t).version,
+                         '1.15.2')
+        self.assertEqual(Tilemap.where(
+            cond, Tile('minecraft:air'), Tile('minecraft:stone', '1.16.5')
+        ).version, '1.16.5')
+        self.assertEqual(Tilemap.where(
+            cond, Tile('minecraft:air'), Tile('minecraft:stone'), '1.16.5'
+        ).version, '1.16.5')
+        with self.assertRaises(ValueError):
+            Tilemap.where(cond, Tile('minecraft:air'), Tile('minecraft:stone'))
+
+    def test_counts(self):
+        for sparse in (False, True):
+            t = Tilemap(shape=(20,20,20), sparse=sparse)
+            self.assertEqual(t.counts(), {Tile('minecraft:air'): 8000})
+            #Edits update the cached counts
+            t[:, :5, :] = Tile('minecraft:stone')
+            t[0, 0, 0] = Tile('minecraft:dirt')
+            t[10:, 4:6, :] = t[:10, :2, :]
+            mask = np.arange(8000).reshape((20,20,20)) % 7 == 0
+            t.fill(mask, Tile('minecraft:glass'))
+            t.replace({'minecraft:dirt': 'minecraft:stone'})
+            with t.batch():
+                t[19, 19, 19] = Tile('minecraft:sand')
+                t[19, 19, 19] = Tile('minecraft:cave_air')
+            expected = {}
+            for x, y, z in np.ndindex(20,20,20):
+                expected[t[x,y,z]] = expected.get(t[x,y,z], 0) + 1
+            self.assertEqual(t.counts(), expected)
+            t._counts = None
+            self.assertEqual(t.counts(), expected)
+
+            stats = t.stats()
+            air = expected[Tile('minecraft:air')] + 1
+            self.assertEqual(stats, {'blocks': 8000, 'air': air,
+                                     'air_ratio': air / 8000, 'tiles': 4})
+            glass = np.count_nonzero(mask[:10, :5, :])
+            self.assertEqual(t[:10, :5, :].counts(),
+                             {Tile('minecraft:stone'): 1000 - glass,
+                              Tile('minecraft:glass'): glass})
+
+            #Index arrays selecting blocks more than once
+            old = [t[0,19,0], t[1,19,0]]
+            t[[0, 0, 0, 1], 19, 0] = Tile('minecraft:sand')
+            for tile in old:
+                expected[tile] -= 1
+            expected[Tile('minecraft:sand')] = 2
+            self.assertEqual(t.counts(), expected)
+
+            #Failed assignments don't change the counts
+            with self.assertRaises(ValueError):
+                t[0:2,:,:] = Tilemap(shape=(3,3,3))
+            self.assertEqual(t.counts(), expected)
+
+    def test_npy(self):
+        dense = Tilemap(shape=(20,40,20), version='1.16.5')
+        dense[:, :16, :] = Tile('minecraft:stone')
+        dense[3:7, 16:19, 5:15] = Tile('minecraft:oak_planks')
+        sparse = Schematic(data=dense.data, palette=list(dense.palette),
+                           version='1.16.5', sparse=True)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for t in (dense, sparse):
+                pth = os.path.join(tmp_dir, 'tilemap.npy')
+                t.save_npy(pth)
+                self.assertTrue(os.path.isfile(
+                    os.path.join(tmp_dir, 'tilemap.json')))
+
+                opened = Schematic.open_mmap(pth)
+                self.assertIsInstance(opened.data, np.memmap)
+                self.assertEqual(opened.data.dtype, np.uint8)
+                self.assertTrue(opened.equals(dense))
+                self.assertEqual(opened.version, '1.16.5')
+                self.assertEqual(opened.stats()['tiles'], 3)
+                buffers = [io.BytesIO(), io.BytesIO()]
+                Schematic.save(dense, buffers[0])
+                opened.save(buffers[1])
+                self.assertEqual(buffers[0].getvalue()[10:],
+                                 buffers[1].getvalue()[10:])
+                #Read-only tilemaps can't be modified in place
+                with self.assertRaises(ValueError):
+                    opened[0,0,0] = Tile('minecraft:stone')
+                del opened
+
+            #Assignments are written to the file
+            opened = Tilemap.open_mmap(pth, mode='r+')
+            opened[0,0,0] = Tile('minecraft:oak_planks')
+            opened.data.flush()
+            del opened
+            self.assertEqual(Tilemap.open_mmap(pth)[0,0,0].name,
+                             'oak_planks')
+
+            #New tiles copy the data into memory, the file is unchanged
+            opened = Tilemap.open_mmap(pth, mode='r+')
+            opened[1,0,0] = Tile('minecraft:glass')
+            self.assertNotIsInstance(opened.data, np.memmap)
+            del opened
+            reopened = Tilemap.open_mmap(pth)
+            self.assertEqual(reopened[1,0,0].name, 'stone')
+            self.assertEqual(reopened.stats()['tiles'], 3)
+
+            #Saving to the path of the opened file
+            opened = Tilemap.open_mmap(pth, mode='c')
+            opened[2,0,0] = Tile('minecraft:glass')
+            opened[3,0,0] = Tile('minecraft:oak_planks')
+            opened.save_npy(pth)
+            expected = Tilemap(data=np.array(opened.data),
+                               palette=list(opened.palette))
+            del opened, reopened
+            self.assertTrue(Tilemap.open_mmap(pth).equals(expected))
+            self.assertEqual(Tilemap.open_mmap(pth)[2,0,0].name, 'glass')
+            self.assertEqual(sorted(os.listdir(tmp_dir)),
+                             ['tilemap.json', 'tilemap.npy'])
+
+    def test_equality(self):
+        d = np.array([[[0,0],[0,1]],[[1,0],[1,1]]])
+        p = [Tile('minecraft:air'), Tile('minecraft:stone')]
+        a = Tilemap(data=d, palette=p)
+        b = Tilemap(data=1-d, palette=p[::-1] + [Tile('minecraft:dirt')])
+        self.assertTrue(a.equals(b))
+        b[0,0,0] = Tile('minecraft:dirt')
+        self.assertFalse(a.equals(b))
+        self.assertFalse(a.equals(Tilemap(shape=(2,2,3))))
+        #Tilemaps are hashable, == compares them by identity
+        self.assertEqual(len({a, b, a}), 2)
+        self.assertNotEqual(a, Tilemap(data=d, palette=p))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file